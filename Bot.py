@@ -1,53 +1,863 @@
 import os
+import atexit
 import logging
-from decimal import Decimal
+import logging.handlers
+from decimal import Decimal, InvalidOperation, ROUND_UP
 import random
 import asyncio
+import bisect
+import collections
+import csv
+import functools
+import io
+import heapq
+import itertools
+import json
+import multiprocessing
+import queue
+import signal
+import statistics
+import sys
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import asdict, dataclass
 from datetime import datetime, timedelta
-import psycopg2
-from psycopg2 import sql
-from psycopg2.extras import DictCursor
+from urllib.parse import urlsplit
+import aiohttp
+import asyncpg
+from aiohttp import web
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer, TELEGRAM_PRODUCTION
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiogram.dispatcher.storage import BaseStorage
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.utils import executor
-import requests
+from aiogram.utils.exceptions import BadRequest, RetryAfter, Unauthorized
 from dotenv import load_dotenv
 
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
+
 # Загрузка переменных окружения
 load_dotenv()
 
 # Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('bot.log'),
-        logging.StreamHandler()
-    ]
-)
+# Вызов логгера только кладет запись в очередь, запись в файл и консоль
+# выполняет фоновый поток. Файл ротируется по размеру или по времени (LOG_ROTATE_WHEN)
+LOG_FILE = os.getenv('LOG_FILE', 'bot.log')
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+LOG_ROTATE_WHEN = os.getenv('LOG_ROTATE_WHEN', '')
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(50 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '5'))
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'process': record.processName,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+def create_log_handlers():
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    if LOG_FORMAT == 'json':
+        formatter = JsonLogFormatter()
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    handlers = [file_handler, logging.StreamHandler()]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+def route_logs(log_queue):
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(LOG_LEVEL)
+
+def start_log_listener(log_queue, handlers):
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+# Файлом владеет только главный процесс; дочерние процессы получают очередь
+# через worker_log_queue() и передают записи ему, чтобы ротация не конфликтовала
+log_handlers = []
+if multiprocessing.current_process().name == 'MainProcess':
+    log_handlers = create_log_handlers()
+    log_queue = queue.SimpleQueue()
+    route_logs(log_queue)
+    start_log_listener(log_queue, log_handlers)
 logger = logging.getLogger(__name__)
 
+def worker_log_queue(context):
+    log_queue = context.Queue()
+    start_log_listener(log_queue, log_handlers)
+    return log_queue
+
 # Конфигурация бота
 API_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 ADMIN_IDS = list(map(int, os.getenv('ADMIN_IDS').split(',')))
 BITCOIN_WALLET = os.getenv('BITCOIN_WALLET')
-BLOCKCHAIN_API_URL = 'https://blockchain.info/'
+BLOCKCHAIN_API_URL = os.getenv('BLOCKCHAIN_API_URL', 'https://blockchain.info/')
+TELEGRAM_API_SERVER = os.getenv('TELEGRAM_API_SERVER')
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+SKIP_UPDATES = os.getenv('SKIP_UPDATES', '0') == '1'
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '127.0.0.1')
+WEBAPP_PORT = int(os.getenv('WEBAPP_PORT', '8080'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+SHARD_WORKERS = int(os.getenv('SHARD_WORKERS', '0'))
+LEADER_CHECK_INTERVAL = int(os.getenv('LEADER_CHECK_INTERVAL', '10'))
+LEADER_LOCK_KEY = 726151
+HTTP_TIMEOUT = float(os.getenv('HTTP_TIMEOUT', '10'))
+RATE_REFRESH_INTERVAL = int(os.getenv('RATE_REFRESH_INTERVAL', '300'))
+RATE_MAX_STALENESS = int(os.getenv('RATE_MAX_STALENESS', '1800'))
+RATE_SOURCES = [name.strip() for name in os.getenv('RATE_SOURCES', 'blockchain,coingecko,cryptocompare').split(',') if name.strip()]
+RATE_SOURCE_TIMEOUT = float(os.getenv('RATE_SOURCE_TIMEOUT', '3'))
+RATE_HISTORY_SIZE = int(os.getenv('RATE_HISTORY_SIZE', '60'))
+COINGECKO_API_URL = os.getenv('COINGECKO_API_URL', 'https://api.coingecko.com/api/v3/')
+CRYPTOCOMPARE_API_URL = os.getenv('CRYPTOCOMPARE_API_URL', 'https://min-api.cryptocompare.com/data/')
+CATALOG_TTL = int(os.getenv('CATALOG_TTL', '600'))
+CATALOG_PAGE_SIZE = int(os.getenv('CATALOG_PAGE_SIZE', '8'))
+IMPORT_ERROR_PREVIEW = 10
+LOW_STOCK_THRESHOLD = int(os.getenv('LOW_STOCK_THRESHOLD', '5'))
+STOCK_REFRESH_INTERVAL = int(os.getenv('STOCK_REFRESH_INTERVAL', '300'))
+PAYMENT_POLL_INTERVAL = int(os.getenv('PAYMENT_POLL_INTERVAL', '20'))
+RAWADDR_PAGE_SIZE = 50
+SATOSHI_TAG_RANGE = int(os.getenv('SATOSHI_TAG_RANGE', '300'))
+SATOSHI_TAG_MAX_UTILIZATION = float(os.getenv('SATOSHI_TAG_MAX_UTILIZATION', '0.5'))
+ORDER_TTL = timedelta(minutes=30)
+ORDER_SWEEP_INTERVAL = int(os.getenv('ORDER_SWEEP_INTERVAL', '600'))
+ORDER_JOURNAL_QUEUE_SIZE = int(os.getenv('ORDER_JOURNAL_QUEUE_SIZE', '10000'))
+ORDER_JOURNAL_BATCH = int(os.getenv('ORDER_JOURNAL_BATCH', '500'))
+ORDER_JOURNAL_INTERVAL = float(os.getenv('ORDER_JOURNAL_INTERVAL', '0.5'))
+ORDER_JOURNAL_MAX_FAILURES = 3
+FULFIL_RETRY_INTERVAL = int(os.getenv('FULFIL_RETRY_INTERVAL', '30'))
+FULFIL_RETRY_MAX_INTERVAL = int(os.getenv('FULFIL_RETRY_MAX_INTERVAL', '600'))
+SEND_WORKERS = int(os.getenv('SEND_WORKERS', '8'))
+SEND_GLOBAL_RATE = float(os.getenv('SEND_GLOBAL_RATE', '30'))
+SEND_CHAT_RATE = float(os.getenv('SEND_CHAT_RATE', '1'))
+SEND_CHAT_BURST = int(os.getenv('SEND_CHAT_BURST', '3'))
+SEND_MAX_RETRIES = int(os.getenv('SEND_MAX_RETRIES', '5'))
+SEND_RETRY_DELAY = float(os.getenv('SEND_RETRY_DELAY', '1'))
+ADMIN_DIGEST_INTERVAL = int(os.getenv('ADMIN_DIGEST_INTERVAL', '0'))
+FLOOD_RATE = float(os.getenv('FLOOD_RATE', '1'))
+FLOOD_BURST = int(os.getenv('FLOOD_BURST', '5'))
+# Стоимость нажатия по действию кнопки: "действие=цена,..."; остальные стоят 1
+FLOOD_CALLBACK_COSTS = {
+    name: float(cost)
+    for name, cost in (
+        item.split('=') for item in
+        os.getenv('FLOOD_CALLBACK_COSTS', 'check_payment=3,location=2').split(',') if item
+    )
+}
+
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '86400'))
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.05'))
+FSM_FLUSH_BATCH = int(os.getenv('FSM_FLUSH_BATCH', '100'))
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+PROFILER_ENABLED = os.getenv('PROFILER_ENABLED', '0') == '1'
+PROFILER_INTERVAL = float(os.getenv('PROFILER_INTERVAL', '0.005'))
+
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+
+# Метрики в формате Prometheus. Запись - несколько операций со словарем,
+# текст формируется только при запросе /metrics
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = []
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+        METRICS.append(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, labels, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label_names, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labels)
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.series = collections.Counter()
+        METRICS.append(self)
+
+    def inc(self, *labels, amount=1):
+        self.series[labels] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in self.series.items():
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {value}")
+        return lines
+
+# Значение вычисляется при запросе: число или словарь {метки: значение}
+class Gauge:
+    def __init__(self, name, help_text, label_names, collect):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.collect = collect
+        METRICS.append(self)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.collect()
+        except Exception as e:
+            logger.error(f"Error collecting metric {self.name}: {e}")
+            return lines
+        items = value.items() if isinstance(value, dict) else [((), value)]
+        for labels, item in items:
+            lines.append(f"{self.name}{_format_labels(self.label_names, labels)} {item}")
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+handler_latency = Histogram('bot_handler_seconds', 'Handler latency', ('handler',))
+query_latency = Histogram('bot_db_query_seconds', 'Database query latency by statement', ('statement',))
+external_latency = Histogram('bot_external_call_seconds', 'Outbound API call latency', ('call',))
+rate_cache_lookups = Counter('bot_rate_cache_lookups_total', 'Bitcoin rate cache lookups', ('result',))
+
+def timed_handler(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with handler_latency.time(func.__name__):
+            return await func(*args, **kwargs)
+    return wrapper
+
+# Метка запроса - имя его константы SQL_*: обрезанный текст запроса
+# склеивал разные запросы с общим началом в одну серию. Разовые запросы без
+# константы помечаются началом текста и его контрольной суммой
+_statement_labels = {}
+
+def statement_label(query):
+    label = _statement_labels.get(query)
+    if label is None:
+        for name, value in globals().items():
+            if name.startswith('SQL_') and isinstance(value, str):
+                _statement_labels.setdefault(value, name[4:].lower())
+        label = _statement_labels.get(query)
+    if label is None:
+        text = ' '.join(query.split())
+        label = _statement_labels[query] = f"{text[:48]} #{zlib.crc32(text.encode()):08x}"
+    return label
+
+# Сэмплирующий профилировщик: фоновый поток снимает стек потока event loop
+# и считает свернутые стеки (формат flamegraph)
+class SamplingProfiler:
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = collections.Counter()
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.samples = collections.Counter()
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name='profiler', daemon=True)
+        self._thread.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.samples[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        if self._thread is None:
+            return ''
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        return '\n'.join(f"{stack} {count}" for stack, count in self.samples.most_common()) + '\n'
+
+profiler = SamplingProfiler(PROFILER_INTERVAL)
+
+async def handle_metrics(request):
+    return web.Response(text=render_metrics(), content_type='text/plain', charset='utf-8')
+
+async def handle_profile_start(request):
+    profiler.start()
+    return web.Response(text="profiler started\n")
+
+async def handle_profile_stop(request):
+    return web.Response(text=profiler.stop(), content_type='text/plain', charset='utf-8')
+
+metrics_runner = None
+
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    if PROFILER_ENABLED:
+        app.router.add_post('/debug/profile/start', handle_profile_start)
+        app.router.add_post('/debug/profile/stop', handle_profile_stop)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Metrics server listening on {METRICS_HOST}:{METRICS_PORT}")
+
+async def stop_metrics_server():
+    global metrics_runner
+    profiler.stop()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+        metrics_runner = None
 
 # Подключение к базе данных
-def get_db_connection():
-    return psycopg2.connect(
-        dbname=os.getenv('DB_NAME'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        host=os.getenv('DB_HOST'),
-        port=os.getenv('DB_PORT')
+# Частые запросы подготавливаются один раз на каждом соединении пула
+SQL_ACTIVE_CATEGORIES = "SELECT id, name FROM categories WHERE is_active = TRUE"
+# Товары листаются страницами по ключу (id), а не через OFFSET: каждая страница
+# читается из индекса products (category_id, is_active, id) и стоит одинаково
+SQL_PRODUCT_PAGE_AFTER = """
+    SELECT id, name, price_rub FROM products
+    WHERE category_id = $1 AND is_active = TRUE AND id > $2
+    ORDER BY id
+    LIMIT $3
+"""
+SQL_PRODUCT_PAGE_BEFORE = """
+    SELECT id, name, price_rub FROM products
+    WHERE category_id = $1 AND is_active = TRUE AND id < $2
+    ORDER BY id DESC
+    LIMIT $3
+"""
+SQL_PRODUCT = """
+    SELECT p.id, p.name, p.description, p.price_rub, p.category_id, c.name as category_name
+    FROM products p
+    JOIN categories c ON p.category_id = c.id
+    WHERE p.id = $1 AND p.is_active = TRUE AND c.is_active = TRUE
+"""
+SQL_ACTIVE_LOCATIONS = "SELECT id, name FROM locations WHERE is_active = TRUE ORDER BY id"
+SQL_SHOP_INFO = "SELECT about_text FROM shop_info LIMIT 1"
+# Ссылка выдается одним запросом: выбор свободной строки и пометка в одной операции
+SQL_CLAIM_LINK = """
+    UPDATE location_links SET is_used = TRUE
+    WHERE id = (
+        SELECT id FROM location_links
+        WHERE location_id = $1 AND is_used = FALSE
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
     )
+    RETURNING content_link
+"""
+SQL_LINK_STOCK = """
+    SELECT location_id, count(*) AS stock
+    FROM location_links
+    WHERE is_used = FALSE
+    GROUP BY location_id
+"""
+
+HOT_QUERIES = (
+    SQL_ACTIVE_CATEGORIES,
+    SQL_PRODUCT_PAGE_AFTER,
+    SQL_PRODUCT_PAGE_BEFORE,
+    SQL_PRODUCT,
+    SQL_ACTIVE_LOCATIONS,
+    SQL_SHOP_INFO,
+    SQL_CLAIM_LINK,
+)
+
+db_pool = None
+db_connections_opened = 0
+
+class BotConnection(asyncpg.Connection):
+    __slots__ = ('prepared',)
+
+async def init_db_connection(conn):
+    global db_connections_opened
+    db_connections_opened += 1
+    conn.prepared = {}
+    for query in HOT_QUERIES:
+        conn.prepared[query] = await conn.prepare(query)
+
+DB_CONNECT_KWARGS = dict(
+    database=os.getenv('DB_NAME'),
+    user=os.getenv('DB_USER'),
+    password=os.getenv('DB_PASSWORD'),
+    host=os.getenv('DB_HOST'),
+    port=int(os.getenv('DB_PORT', '5432'))
+)
+
+async def create_db_pool():
+    global db_pool
+    db_pool = await asyncpg.create_pool(
+        **DB_CONNECT_KWARGS,
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        connection_class=BotConnection,
+        init=init_db_connection
+    )
+    logger.info(f"Database pool created (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+
+async def close_db_pool():
+    global db_pool
+    if db_pool is not None:
+        await db_pool.close()
+        db_pool = None
+
+# Схема, нужная частым запросам: колонки журнала заказов, свертка продаж и индексы.
+# Каждый объект сначала проверяется, DDL выполняется только для отсутствующих,
+# так что обычный перезапуск не берет блокировок на таблицы
+SCHEMA_CHECK_RELATION = "SELECT to_regclass($1) IS NOT NULL"
+SCHEMA_CHECK_COLUMN = """
+    SELECT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = $1 AND column_name = $2
+    )
+"""
+SCHEMA_LOCK_KEY = 726152
+SCHEMA_OBJECTS = (
+    (SCHEMA_CHECK_COLUMN, ('orders', 'updated_at'), """
+    ALTER TABLE orders
+        ADD COLUMN IF NOT EXISTS order_ref TEXT,
+        ADD COLUMN IF NOT EXISTS username TEXT,
+        ADD COLUMN IF NOT EXISTS product_id INTEGER,
+        ADD COLUMN IF NOT EXISTS location_id INTEGER,
+        ADD COLUMN IF NOT EXISTS price_rub NUMERIC,
+        ADD COLUMN IF NOT EXISTS btc_amount NUMERIC,
+        ADD COLUMN IF NOT EXISTS unique_satoshi INTEGER,
+        ADD COLUMN IF NOT EXISTS expires_at TIMESTAMP,
+        ADD COLUMN IF NOT EXISTS status TEXT NOT NULL DEFAULT 'pending',
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP
+    """),
+    (SCHEMA_CHECK_COLUMN, ('orders', 'rate_rub'), """
+    ALTER TABLE orders ADD COLUMN IF NOT EXISTS rate_rub NUMERIC
+    """),
+    (SCHEMA_CHECK_RELATION, ('orders_order_ref_idx',), """
+    CREATE UNIQUE INDEX IF NOT EXISTS orders_order_ref_idx
+    ON orders (order_ref)
+    """),
+    (SCHEMA_CHECK_RELATION, ('sales_daily',), """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day DATE NOT NULL,
+        product_id INTEGER NOT NULL,
+        location_id INTEGER NOT NULL,
+        orders INTEGER NOT NULL DEFAULT 0,
+        revenue_rub NUMERIC NOT NULL DEFAULT 0,
+        revenue_btc NUMERIC NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, product_id, location_id)
+    )
+    """),
+    # Ожидающие заказы: и по is_paid, и по created_at, только нужные строки
+    (SCHEMA_CHECK_RELATION, ('orders_pending_created_at_idx',), """
+    CREATE INDEX IF NOT EXISTS orders_pending_created_at_idx
+    ON orders (created_at)
+    WHERE is_paid = FALSE AND is_cancelled = FALSE
+    """),
+    # Покрывает и поиск по одному category_id
+    (SCHEMA_CHECK_RELATION, ('products_category_active_id_idx',), """
+    CREATE INDEX IF NOT EXISTS products_category_active_id_idx
+    ON products (category_id, is_active, id)
+    """),
+    (SCHEMA_CHECK_RELATION, ('location_links_location_used_idx',), """
+    CREATE INDEX IF NOT EXISTS location_links_location_used_idx
+    ON location_links (location_id, is_used)
+    """),
+)
+
+async def ensure_schema():
+    # Отдельное соединение до создания пула: запросы, подготовленные
+    # на соединениях пула, сразу видят итоговую схему
+    conn = await asyncpg.connect(**DB_CONNECT_KWARGS)
+    try:
+        missing = [
+            statement for check, args, statement in SCHEMA_OBJECTS
+            if not await conn.fetchval(check, *args)
+        ]
+        if not missing:
+            return
+        async with conn.transaction():
+            # Одновременно стартующие процессы применяют схему по очереди
+            await conn.execute("SELECT pg_advisory_xact_lock($1)", SCHEMA_LOCK_KEY)
+            for statement in missing:
+                await conn.execute(statement)
+        logger.info(f"Schema bootstrap applied {len(missing)} statements")
+    finally:
+        await conn.close()
+
+async def _db_call(method, query, args):
+    async with db_pool.acquire() as conn:
+        with query_latency.time(statement_label(query)):
+            statement = conn.prepared.get(query)
+            if statement is not None:
+                return await getattr(statement, method)(*args)
+            return await getattr(conn, method)(query, *args)
+
+async def db_fetch(query, *args):
+    return await _db_call('fetch', query, args)
+
+async def db_fetchrow(query, *args):
+    return await _db_call('fetchrow', query, args)
+
+async def db_fetchval(query, *args):
+    return await _db_call('fetchval', query, args)
+
+async def db_execute(query, *args):
+    async with db_pool.acquire() as conn:
+        with query_latency.time(statement_label(query)):
+            return await conn.execute(query, *args)
+
+# Хранилище состояний FSM
+# Компактная сериализация: Decimal, datetime и словари с нестроковыми ключами
+# кодируются тегированными объектами JSON
+def _pack(value):
+    if isinstance(value, Decimal):
+        return {'$d': str(value)}
+    if isinstance(value, datetime):
+        return {'$t': value.isoformat()}
+    if isinstance(value, dict):
+        if all(isinstance(key, str) for key in value):
+            return {key: _pack(item) for key, item in value.items()}
+        return {'$m': [[_pack(key), _pack(item)] for key, item in value.items()]}
+    if isinstance(value, (list, tuple)):
+        return [_pack(item) for item in value]
+    return value
+
+def _unpack(value):
+    if isinstance(value, list):
+        return [_unpack(item) for item in value]
+    if isinstance(value, dict):
+        if len(value) == 1:
+            if '$d' in value:
+                return Decimal(value['$d'])
+            if '$t' in value:
+                return datetime.fromisoformat(value['$t'])
+            if '$m' in value:
+                return {_unpack(key): _unpack(item) for key, item in value['$m']}
+        return {key: _unpack(item) for key, item in value.items()}
+    return value
+
+def dump_fsm_record(state, data):
+    return json.dumps(_pack({'s': state, 'd': data}), separators=(',', ':')).encode()
+
+def load_fsm_record(raw):
+    record = _unpack(json.loads(raw))
+    return record['s'], record['d']
+
+class PostgresKV:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._task = None
+
+    async def setup(self):
+        await db_execute("""
+            CREATE TABLE IF NOT EXISTS fsm_storage (
+                key TEXT PRIMARY KEY,
+                value BYTEA NOT NULL,
+                expires_at TIMESTAMPTZ NOT NULL
+            )
+        """)
+        if self._task is None:
+            self._task = asyncio.create_task(self._expire_loop())
+
+    async def get(self, key):
+        return await db_fetchval(
+            "SELECT value FROM fsm_storage WHERE key = $1 AND expires_at > NOW()",
+            key
+        )
+
+    async def write_many(self, items):
+        upserts = [(key, value) for key, value in items.items() if value is not None]
+        deletes = [key for key, value in items.items() if value is None]
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                if upserts:
+                    await conn.execute("""
+                        INSERT INTO fsm_storage (key, value, expires_at)
+                        SELECT key, value, NOW() + make_interval(secs => $3)
+                        FROM unnest($1::text[], $2::bytea[]) AS t(key, value)
+                        ON CONFLICT (key) DO UPDATE
+                        SET value = EXCLUDED.value, expires_at = EXCLUDED.expires_at
+                    """, [k for k, _ in upserts], [v for _, v in upserts], float(self.ttl))
+                if deletes:
+                    await conn.execute("DELETE FROM fsm_storage WHERE key = ANY($1::text[])", deletes)
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(3600)
+            try:
+                await db_execute("DELETE FROM fsm_storage WHERE expires_at <= NOW()")
+            except Exception as e:
+                logger.error(f"Error expiring FSM states: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+# Локальная замена Redis-клиента для тестов и одиночного процесса
+class LocalRedis:
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        value, expires_at = item
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._data[key]
+            return None
+        return value
+
+    def pipeline(self, transaction=False):
+        return _LocalPipeline(self)
+
+    async def close(self):
+        pass
+
+class _LocalPipeline:
+    def __init__(self, client):
+        self.client = client
+        self._ops = []
+
+    def set(self, key, value, ex=None):
+        self._ops.append((key, value, ex))
+
+    def delete(self, *keys):
+        self._ops.extend((key, None, None) for key in keys)
+
+    async def execute(self):
+        for key, value, ex in self._ops:
+            if value is None:
+                self.client._data.pop(key, None)
+            else:
+                expires_at = time.monotonic() + ex if ex else None
+                self.client._data[key] = (value, expires_at)
+        self._ops = []
+
+class RedisKV:
+    def __init__(self, client, ttl):
+        self.client = client
+        self.ttl = ttl
+
+    async def setup(self):
+        pass
+
+    async def get(self, key):
+        return await self.client.get(key)
+
+    async def write_many(self, items):
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in items.items():
+            if value is None:
+                pipe.delete(key)
+            else:
+                pipe.set(key, value, ex=self.ttl)
+        await pipe.execute()
+
+    async def close(self):
+        await self.client.close()
+
+# Состояние и данные пользователя хранятся одной записью; записи копятся
+# в буфере и сбрасываются в хранилище пачками
+class KeyValueStorage(BaseStorage):
+    def __init__(self, backend, flush_interval, flush_batch):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self._pending = {}
+        # Пачка, которая сейчас пишется: до подтверждения записи читается отсюда
+        self._inflight = {}
+        self._flush_handle = None
+        self._flush_lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(chat, user):
+        return f"fsm:{chat}:{user}"
+
+    async def setup(self):
+        await self.backend.setup()
+
+    async def _read(self, chat, user):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = self._key(chat, user)
+        if key in self._pending:
+            raw = self._pending[key]
+        elif key in self._inflight:
+            raw = self._inflight[key]
+        else:
+            raw = await self.backend.get(key)
+        if raw is None:
+            return None, {}
+        return load_fsm_record(raw)
+
+    async def _write(self, chat, user, state, data):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = self._key(chat, user)
+        self._pending[key] = dump_fsm_record(state, data) if state is not None or data else None
+        if len(self._pending) >= self.flush_batch:
+            await self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(
+                self.flush_interval, lambda: asyncio.ensure_future(self.flush())
+            )
+
+    async def flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._inflight, self._pending = self._pending, {}
+            try:
+                await self.backend.write_many(self._inflight)
+            except Exception as e:
+                logger.error(f"Error flushing {len(self._inflight)} FSM records: {e}")
+                # Неудачная пачка возвращается в буфер, более новые записи важнее,
+                # и повторяется по таймеру, не дожидаясь новых записей
+                self._pending = {**self._inflight, **self._pending}
+                self._schedule_flush()
+            finally:
+                self._inflight = {}
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        state, _ = await self._read(chat, user)
+        return self.resolve_state(state if state is not None else default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        _, data = await self._read(chat, user)
+        return data or dict(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        _, data = await self._read(chat, user)
+        await self._write(chat, user, self.resolve_state(state), data)
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        state, _ = await self._read(chat, user)
+        await self._write(chat, user, state, dict(data or {}))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        state, current = await self._read(chat, user)
+        current.update(data or {}, **kwargs)
+        await self._write(chat, user, state, current)
+
+    async def close(self):
+        await self.flush()
+        await self.backend.close()
+
+    async def wait_closed(self):
+        pass
+
+def create_fsm_storage():
+    if FSM_STORAGE == 'postgres':
+        return KeyValueStorage(PostgresKV(FSM_STATE_TTL), FSM_FLUSH_INTERVAL, FSM_FLUSH_BATCH)
+    if FSM_STORAGE == 'redis':
+        if REDIS_URL.startswith('local://'):
+            client = LocalRedis()
+        elif aioredis is None:
+            raise RuntimeError("FSM_STORAGE=redis requires the 'redis' package")
+        else:
+            client = aioredis.from_url(REDIS_URL)
+        return KeyValueStorage(RedisKV(client, FSM_STATE_TTL), FSM_FLUSH_INTERVAL, FSM_FLUSH_BATCH)
+    return MemoryStorage()
 
 # Инициализация бота
-bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+bot = Bot(
+    token=API_TOKEN,
+    server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER) if TELEGRAM_API_SERVER else TELEGRAM_PRODUCTION
+)
+storage = create_fsm_storage()
 dp = Dispatcher(bot, storage=storage)
 
 # Состояния FSM
@@ -64,97 +874,1214 @@ class AdminStates(StatesGroup):
     editing_shop_info = State()
     editing_product = State()
     editing_location = State()
+    bulk_import = State()
+
+# Очередь исходящих сообщений: общий лимит Telegram и лимит на чат,
+# повтор при RetryAfter и сетевых сбоях, ответы пользователям идут раньше
+# уведомлений админам. Не повторяются только ошибки, которые повтор не исправит:
+# бот заблокирован, чат не найден, неверный запрос
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self):
+        self._refill()
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def try_take(self, cost):
+        self._refill()
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def is_idle(self):
+        return self.tokens + (time.monotonic() - self.updated_at) * self.rate >= self.capacity
+
+class ChatOutbox:
+    __slots__ = ('bucket', 'backlog')
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.backlog = None
+
+class SendQueue:
+    def __init__(self, workers, global_rate, chat_rate, chat_burst):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._queue = asyncio.PriorityQueue()
+        self._seq = itertools.count()
+        self.global_rate = global_rate
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._digest = []
+        self._tasks = []
+
+    def partition(self, worker_count):
+        # Лимит Telegram общий для бота: процессы делят его поровну
+        rate = self.global_rate / worker_count
+        self._global = TokenBucket(rate, max(1.0, rate))
+
+    def send(self, chat_id, text, priority=PRIORITY_USER, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((priority, next(self._seq), chat_id, text, kwargs, future))
+        return future
+
+    def notify_admins(self, text):
+        if ADMIN_DIGEST_INTERVAL > 0:
+            self._digest.append(text)
+            return
+        for admin_id in ADMIN_IDS:
+            self.send(admin_id, text, priority=PRIORITY_ADMIN)
+
+    def alert_admins(self, text):
+        # Сбои, требующие вмешательства, не ждут сводки
+        for admin_id in ADMIN_IDS:
+            self.send(admin_id, text, priority=PRIORITY_ADMIN)
+
+    def _chat(self, chat_id):
+        chat = self._chats.get(chat_id)
+        if chat is None:
+            if len(self._chats) > 10000:
+                self._chats = {
+                    key: value for key, value in self._chats.items()
+                    if value.backlog is not None or not value.bucket.is_idle()
+                }
+            chat = self._chats[chat_id] = ChatOutbox(TokenBucket(self.chat_rate, self.chat_burst))
+        return chat
+
+    async def _deliver(self, chat_id, text, kwargs, bucket):
+        for attempt in range(SEND_MAX_RETRIES):
+            await asyncio.sleep(max(bucket.reserve(), self._global.reserve()))
+            try:
+                with external_latency.time('telegram_send_message'):
+                    return await bot.send_message(chat_id, text, **kwargs)
+            except RetryAfter as e:
+                logger.warning(f"Flood limit for chat {chat_id}, retrying in {e.timeout}s")
+                await asyncio.sleep(e.timeout)
+            except (BadRequest, Unauthorized) as e:
+                logger.error(f"Error sending message to {chat_id}: {e}")
+                return None
+            except Exception as e:
+                delay = SEND_RETRY_DELAY * 2 ** attempt
+                logger.warning(f"Error sending message to {chat_id}, retrying in {delay}s: {e}")
+                await asyncio.sleep(delay)
+        logger.error(f"Giving up sending message to {chat_id} after {SEND_MAX_RETRIES} attempts")
+        return None
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            chat_id = item[2]
+            chat = self._chat(chat_id)
+            if chat.backlog is not None:
+                # Чат уже обслуживает другой воркер - сообщение встанет
+                # за предыдущими, порядок для пользователя сохраняется
+                chat.backlog.append(item)
+                continue
+            
+            chat.backlog = collections.deque([item])
+            try:
+                while chat.backlog:
+                    _, _, _, text, kwargs, future = chat.backlog.popleft()
+                    result = await self._deliver(chat_id, text, kwargs, chat.bucket)
+                    if not future.done():
+                        future.set_result(result)
+                    self._queue.task_done()
+            finally:
+                chat.backlog = None
+
+    async def _digest_loop(self):
+        while True:
+            await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+            self.flush_digest()
+
+    def flush_digest(self):
+        if not self._digest:
+            return
+        entries, self._digest = self._digest, []
+        chunks, chunk = [], f"Заказы за период: {len(entries)}"
+        for entry in entries:
+            if len(chunk) + len(entry) + 2 > 4000:
+                chunks.append(chunk)
+                chunk = entry
+            else:
+                chunk += "\n\n" + entry
+        chunks.append(chunk)
+        for admin_id in ADMIN_IDS:
+            for chunk in chunks:
+                self.send(admin_id, chunk, priority=PRIORITY_ADMIN)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+            if ADMIN_DIGEST_INTERVAL > 0:
+                self._tasks.append(asyncio.create_task(self._digest_loop()))
+
+    async def stop(self, timeout=10):
+        self.flush_digest()
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Send queue stopped with {self._queue.qsize()} undelivered messages")
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+outbox = SendQueue(SEND_WORKERS, SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST)
+
+Gauge('bot_send_queue_size', 'Messages waiting in the send queue', (), lambda: outbox._queue.qsize())
+
+# Данные кнопок: версия формата, код действия и целые поля в base36 через ':',
+# например "1l:2s:5" - локация 5 для товара 100. Чужие, устаревшие и битые
+# данные отбрасываются при разборе и не доходят до обработчиков
+CALLBACK_VERSION = '1'
+CALLBACK_DATA_LIMIT = 64
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+def to_base36(value):
+    if value < 0:
+        raise ValueError(f"Negative callback field: {value}")
+    digits = []
+    while True:
+        value, digit = divmod(value, 36)
+        digits.append(BASE36_DIGITS[digit])
+        if not value:
+            return ''.join(reversed(digits))
+
+class CallbackAction:
+    __slots__ = ('code', 'name', 'fields')
+
+    def __init__(self, code, name, fields):
+        self.code = code
+        self.name = name
+        self.fields = fields
+
+    def pack(self, *values):
+        if len(values) != len(self.fields):
+            raise ValueError(f"{self.name} expects {len(self.fields)} fields, got {len(values)}")
+        data = CALLBACK_VERSION + self.code + ''.join(':' + to_base36(int(value)) for value in values)
+        if len(data.encode()) > CALLBACK_DATA_LIMIT:
+            raise ValueError(f"callback_data for {self.name} exceeds {CALLBACK_DATA_LIMIT} bytes")
+        return data
+
+callback_actions = {}
+
+def callback_action(code, name, *fields):
+    action = callback_actions[code] = CallbackAction(code, name, fields)
+    return action
+
+def unpack_callback(data):
+    # Возвращает (действие, поля) или None
+    if not data or data[0] != CALLBACK_VERSION:
+        return None
+    code, *values = data[1:].split(':')
+    action = callback_actions.get(code)
+    if action is None or len(values) != len(action.fields):
+        return None
+    try:
+        fields = {field: int(value, 36) for field, value in zip(action.fields, values)}
+        # int() принимает знак, пробелы, '_' и ведущие нули: допускается только
+        # то, что выдает pack()
+        if any(to_base36(fields[field]) != value for field, value in zip(action.fields, values)):
+            return None
+    except ValueError:
+        return None
+    return action, fields
+
+CB_CATEGORY = callback_action('c', 'category', 'category_id')
+CB_PRODUCT_PAGE = callback_action('q', 'product_page', 'category_id', 'cursor', 'backward')
+CB_PRODUCT = callback_action('p', 'product', 'product_id')
+CB_LOCATION_PAGE = callback_action('m', 'location_page', 'product_id', 'cursor', 'backward')
+CB_LOCATION = callback_action('l', 'location', 'product_id', 'location_id')
+CB_CHECK_PAYMENT = callback_action('y', 'check_payment')
+
+# Защита от флуда: у каждого пользователя свое ведро токенов, тяжелые кнопки
+# стоят дороже. Повторные нажатия той же кнопки, пока первое еще обрабатывается,
+# не запускают обработчик заново - на них отвечают, когда он завершится
+flood_rejections = Counter('bot_flood_rejected_total', 'Updates dropped by the anti-flood middleware', ('reason',))
+
+class AntiFloodMiddleware(BaseMiddleware):
+    def __init__(self, rate, burst, callback_costs):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.callback_costs = callback_costs
+        self._buckets = {}
+        self._in_flight = {}
+
+    def _allow(self, user_id, cost):
+        if user_id in ADMIN_IDS:
+            return True
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                self._buckets = {
+                    key: value for key, value in self._buckets.items() if not value.is_idle()
+                }
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket.try_take(cost)
+
+    def _callback_cost(self, data):
+        decoded = unpack_callback(data)
+        if decoded is None:
+            return 1
+        return self.callback_costs.get(decoded[0].name, 1)
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        if not self._allow(message.from_user.id, 1):
+            flood_rejections.inc('message')
+            raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        key = (callback_query.from_user.id, callback_query.data)
+        waiters = self._in_flight.get(key)
+        if waiters is not None:
+            waiters.append(callback_query.id)
+            flood_rejections.inc('coalesced')
+            raise CancelHandler()
+        if not self._allow(callback_query.from_user.id, self._callback_cost(callback_query.data)):
+            flood_rejections.inc('callback')
+            await bot.answer_callback_query(callback_query.id, "Слишком много запросов, подождите немного.")
+            raise CancelHandler()
+        self._in_flight[key] = []
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        waiters = self._in_flight.pop((callback_query.from_user.id, callback_query.data), None)
+        if waiters:
+            await asyncio.gather(
+                *(bot.answer_callback_query(waiter) for waiter in waiters),
+                return_exceptions=True
+            )
+
+dp.middleware.setup(AntiFloodMiddleware(FLOOD_RATE, FLOOD_BURST, FLOOD_CALLBACK_COSTS))
+
+# HTTP-клиент для внешних API, создается при запуске
+http_session = None
+
+async def create_http_session():
+    global http_session
+    http_session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+
+async def close_http_session():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+# Курс Bitcoin: несколько источников опрашиваются параллельно, у каждого свой
+# таймаут, курсом считается медиана ответивших. Обновление идет в фоне, один
+# запрос на все одновременные обновления; оформление заказа берет только кэш
+class RateUnavailable(Exception):
+    pass
+
+# Источник курса: GET с JSON-ответом и путем до числа. Любой объект с name
+# и async fetch() подходит как источник, например локальная заглушка
+class JsonRateProvider:
+    def __init__(self, name, url, path, params=None):
+        self.name = name
+        self.url = url
+        self.path = path
+        self.params = params
+
+    async def fetch(self):
+        with external_latency.time(f'rate_{self.name}'):
+            async with http_session.get(self.url, params=self.params) as response:
+                response.raise_for_status()
+                data = await response.json(content_type=None)
+        for key in self.path:
+            data = data[key]
+        rate = Decimal(str(data))
+        if rate <= 0:
+            raise ValueError(f"non-positive rate {rate}")
+        return rate
+
+RATE_PROVIDERS = {
+    provider.name: provider for provider in (
+        JsonRateProvider('blockchain', f'{BLOCKCHAIN_API_URL}ticker', ('RUB', 'last')),
+        JsonRateProvider(
+            'coingecko', f'{COINGECKO_API_URL}simple/price', ('bitcoin', 'rub'),
+            {'ids': 'bitcoin', 'vs_currencies': 'rub'}
+        ),
+        JsonRateProvider(
+            'cryptocompare', f'{CRYPTOCOMPARE_API_URL}price', ('RUB',),
+            {'fsym': 'BTC', 'tsyms': 'RUB'}
+        ),
+    )
+}
+
+rate_source_errors = Counter('bot_rate_source_errors_total', 'Failed Bitcoin rate source queries', ('source',))
+
+class BitcoinRateService:
+    def __init__(self, providers, refresh_interval, max_staleness, source_timeout, history_size):
+        self.providers = providers
+        self.refresh_interval = refresh_interval
+        self.max_staleness = max_staleness
+        self.source_timeout = source_timeout
+        self.rate = None
+        self.updated_at = None
+        # (время, медиана, курсы по источникам) последних обновлений
+        self.history = collections.deque(maxlen=history_size)
+        self._inflight = None
+        self._task = None
+
+    def age(self):
+        if self.updated_at is None:
+            return None
+        return time.monotonic() - self.updated_at
+
+    async def _query(self, provider):
+        try:
+            return await asyncio.wait_for(provider.fetch(), self.source_timeout)
+        except Exception as e:
+            rate_source_errors.inc(provider.name)
+            logger.warning(f"Rate source {provider.name} failed: {e!r}")
+            return None
+
+    async def _fetch(self):
+        quotes = await asyncio.gather(*(self._query(provider) for provider in self.providers))
+        rates = {provider.name: quote for provider, quote in zip(self.providers, quotes) if quote is not None}
+        if not rates:
+            logger.error("Error updating Bitcoin rate: no source answered")
+            return self.rate
+        self.rate = statistics.median(rates.values())
+        self.updated_at = time.monotonic()
+        self.history.append((datetime.now(), self.rate, rates))
+        logger.info(f"Updated Bitcoin rate: {self.rate} RUB from {len(rates)}/{len(self.providers)} sources")
+        return self.rate
+
+    def refresh(self):
+        if self._inflight is None or self._inflight.done():
+            self._inflight = asyncio.ensure_future(self._fetch())
+        return asyncio.shield(self._inflight)
+
+    def get_rate(self):
+        # Вызывающий никогда не ждет источники: без свежего курса заказ
+        # не оформляется, вместо цены по случайному курсу
+        age = self.age()
+        if age is None or age > self.max_staleness:
+            rate_cache_lookups.inc('miss')
+            self.refresh()
+            raise RateUnavailable("Bitcoin rate is unavailable or too old")
+        if age > self.refresh_interval:
+            rate_cache_lookups.inc('stale')
+            self.refresh()
+        else:
+            rate_cache_lookups.inc('hit')
+        return self.rate
+
+    async def _run(self):
+        # Первый курс загружается при запуске, дальше - по расписанию
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.refresh()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+try:
+    rate_providers = [RATE_PROVIDERS[name] for name in RATE_SOURCES]
+except KeyError as e:
+    raise RuntimeError(f"Unknown rate source {e}; available: {', '.join(RATE_PROVIDERS)}")
+rate_service = BitcoinRateService(
+    rate_providers, RATE_REFRESH_INTERVAL, RATE_MAX_STALENESS, RATE_SOURCE_TIMEOUT, RATE_HISTORY_SIZE
+)
+
+Gauge('bot_btc_rub_rate', 'Current median Bitcoin rate in RUB', (), lambda: rate_service.rate or 0)
+
+# Утилиты
+def get_bitcoin_rate():
+    return rate_service.get_rate()
+
+def satoshi_to_btc(satoshi):
+    return Decimal(satoshi) / Decimal('1e8')
+
+# Уникальные добавки в сатоши для ожидающих оплаты заказов, отдельно для каждой
+# цены. Свободные значения лежат в перемешанном списке и выдаются за O(1);
+# при высокой загрузке диапазон расширяется вдвое
+class TagBucket:
+    __slots__ = ('size', 'free', 'used')
+
+    def __init__(self, size):
+        self.size = 0
+        self.free = []
+        self.used = set()
+        self.grow(size)
+
+    def grow(self, size):
+        tags = list(range(self.size + 1, size + 1))
+        random.shuffle(tags)
+        # Новые, более крупные значения выдаются после оставшихся мелких
+        self.free = tags + self.free
+        self.size = size
+
+class SatoshiTagAllocator:
+    def __init__(self, initial_range, max_utilization):
+        self.initial_range = initial_range
+        self.local_range = initial_range
+        self.max_utilization = max_utilization
+        self._buckets = {}
+        self.worker_index = 0
+        self.worker_count = 1
+
+    def partition(self, worker_index, worker_count):
+        # Каждый процесс выдает только свои значения: index + 1, index + 1 + count, ...
+        # Диапазон делится между процессами, а не копируется каждому: иначе
+        # добавка к цене росла бы вместе с числом процессов
+        self.worker_index = worker_index
+        self.worker_count = worker_count
+        self.local_range = max(1, self.initial_range // worker_count)
+        self._buckets = {}
+
+    def align(self, base_satoshi):
+        # База округляется вверх до кратной числу процессов: тогда остаток суммы
+        # совпадает с остатком метки, и суммы разных процессов не пересекаются
+        # при любых ценах и курсах
+        return -(-base_satoshi // self.worker_count) * self.worker_count
+
+    def _to_tag(self, local):
+        return (local - 1) * self.worker_count + self.worker_index + 1
+
+    def _to_local(self, tag):
+        return (tag - 1) // self.worker_count + 1
+
+    def _bucket(self, key):
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TagBucket(self.local_range)
+        return bucket
+
+    def allocate(self, key, base_satoshi, is_taken):
+        bucket = self._bucket(key)
+        skipped = []
+        try:
+            while True:
+                if not bucket.free or len(bucket.used) >= bucket.size * self.max_utilization:
+                    bucket.grow(bucket.size * 2)
+                    logger.info(f"Satoshi tag range for {key} widened to {bucket.size}")
+                local = bucket.free.pop()
+                # Сумма может совпасть с заказом по той же цене, но по другому курсу
+                if is_taken(base_satoshi + self._to_tag(local)):
+                    skipped.append(local)
+                    continue
+                bucket.used.add(local)
+                return self._to_tag(local)
+        finally:
+            bucket.free.extend(skipped)
+
+    def owns(self, tag):
+        return (tag - 1) % self.worker_count == self.worker_index
+
+    def reserve(self, key, tag):
+        if not self.owns(tag):
+            return
+        local = self._to_local(tag)
+        bucket = self._bucket(key)
+        if local > bucket.size:
+            bucket.grow(max(local, bucket.size * 2))
+        if local not in bucket.used:
+            bucket.used.add(local)
+            bucket.free.remove(local)
+
+    def release(self, key, tag):
+        if not self.owns(tag):
+            return
+        bucket = self._buckets.get(key)
+        local = self._to_local(tag)
+        if bucket is not None and local in bucket.used:
+            bucket.used.discard(local)
+            bucket.free.append(local)
+            if not bucket.used and bucket.size > self.local_range:
+                del self._buckets[key]
+
+    def rebuild(self, orders):
+        self._buckets = {}
+        for order in orders:
+            self.reserve(order.price_rub, order.unique_satoshi)
+
+tag_allocator = SatoshiTagAllocator(SATOSHI_TAG_RANGE, SATOSHI_TAG_MAX_UTILIZATION)
+
+def convert_rub_to_btc(rub_amount, rate):
+    # Сумма округляется до целых сатоши, чтобы ее можно было сопоставить с транзакцией
+    base_satoshi = int((Decimal(rub_amount) / rate * Decimal('1e8')).to_integral_value(ROUND_UP))
+    base_satoshi = tag_allocator.align(base_satoshi)
+    unique_satoshi = tag_allocator.allocate(Decimal(rub_amount), base_satoshi, payment_watcher.is_amount_taken)
+    btc_amount = satoshi_to_btc(base_satoshi + unique_satoshi)
+    return btc_amount, unique_satoshi
+
+# Выдача ссылок и остатки по локациям. Счетчики ведутся в памяти при выдаче
+# и загрузке ссылок и периодически сверяются с базой
+class LinkAllocator:
+    def __init__(self, low_threshold, refresh_interval):
+        self.low_threshold = low_threshold
+        self.refresh_interval = refresh_interval
+        self.stock = {}
+        # Меняется, когда локация становится распроданной или снова доступной
+        self.version = 0
+        self._alerted = set()
+        self._loaded = False
+        self._task = None
+
+    async def load(self):
+        rows = await db_fetch(SQL_LINK_STOCK)
+        stock = {row['location_id']: row['stock'] for row in rows}
+        if {k for k, v in stock.items() if v > 0} != {k for k, v in self.stock.items() if v > 0}:
+            self.version += 1
+        self.stock = stock
+        for location_id in set(stock) | self._alerted:
+            self._check_low_stock(location_id)
+        self._loaded = True
+
+    def available(self, location_id):
+        return self.stock.get(location_id, 0)
+
+    def adjust(self, location_id, delta):
+        before = self.available(location_id)
+        after = max(0, before + delta)
+        self.stock[location_id] = after
+        if (before > 0) != (after > 0):
+            self.version += 1
+        self._check_low_stock(location_id)
+
+    def _check_low_stock(self, location_id):
+        count = self.available(location_id)
+        if count > self.low_threshold:
+            self._alerted.discard(location_id)
+        elif location_id not in self._alerted:
+            self._alerted.add(location_id)
+            # Предупреждает только ведущий процесс; при запуске остатки лишь
+            # запоминаются, чтобы каждый перезапуск не повторял предупреждения
+            if not self._loaded or not background_duties.active:
+                return
+            name = catalog.location_names.get(location_id, location_id)
+            outbox.notify_admins(
+                f"Заканчиваются ссылки в локации '{name}' (ID {location_id}): осталось {count}"
+            )
+
+    async def claim(self, location_id):
+        content_link = await db_fetchval(SQL_CLAIM_LINK, location_id)
+        if content_link is None:
+            self.adjust(location_id, -self.available(location_id))
+        else:
+            self.adjust(location_id, -1)
+        return content_link
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.load()
+            except Exception as e:
+                logger.error(f"Error refreshing link stock: {e}")
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+link_allocator = LinkAllocator(LOW_STOCK_THRESHOLD, STOCK_REFRESH_INTERVAL)
+
+Gauge(
+    'bot_link_stock', 'Unused content links per location', ('location_id',),
+    lambda: {(location_id,): count for location_id, count in link_allocator.stock.items()}
+)
+
+# Отслеживание оплаты
+@dataclass
+class Order:
+    id: str
+    user_id: int
+    username: str
+    product_id: int
+    location_id: int
+    price_rub: Decimal
+    btc_amount: Decimal
+    unique_satoshi: int
+    rate: Decimal
+    created_at: datetime
+    status: str = 'pending'
+    # Выданная ссылка: повторная попытка выдачи не забирает из запаса новую
+    content_link: str = None
+
+    @property
+    def amount_satoshi(self):
+        return int(self.btc_amount * Decimal('1e8'))
+
+    @property
+    def deadline(self):
+        return self.created_at + ORDER_TTL
+
+# Журнал заказов: оформление и смены статуса (paid, cancelled, fulfilled)
+# пишутся в orders фоновой задачей пачками, обработчики не ждут базу.
+# Очередь ограничена: если база не успевает, запись ждет места в очереди
+SQL_JOURNAL_INSERT = """
+    INSERT INTO orders (
+        order_ref, user_id, username, product_id, location_id, price_rub,
+        btc_amount, unique_satoshi, created_at, expires_at, rate_rub
+    )
+    VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+    ON CONFLICT (order_ref) DO NOTHING
+"""
+SQL_JOURNAL_STATUS = """
+    UPDATE orders SET
+        status = $2::text,
+        is_paid = is_paid OR $2::text IN ('paid', 'fulfilled'),
+        is_cancelled = is_cancelled OR $2::text = 'cancelled',
+        updated_at = $3
+    WHERE order_ref = $1
+"""
+# Продажи сворачиваются в sales_daily в той же транзакции, что и статус заказа:
+# отчеты читают только свертку и не зависят от размера истории
+SQL_SALES_UPSERT = """
+    INSERT INTO sales_daily (day, product_id, location_id, orders, revenue_rub, revenue_btc)
+    VALUES ($1, $2, $3, $4, $5, $6)
+    ON CONFLICT (day, product_id, location_id) DO UPDATE SET
+        orders = sales_daily.orders + EXCLUDED.orders,
+        revenue_rub = sales_daily.revenue_rub + EXCLUDED.revenue_rub,
+        revenue_btc = sales_daily.revenue_btc + EXCLUDED.revenue_btc
+"""
+# Оплаченные, но не выданные заказы тоже восстанавливаются: выдача повторяется
+SQL_JOURNAL_PENDING = """
+    SELECT order_ref AS id, user_id, username, product_id, location_id, price_rub,
+           btc_amount, unique_satoshi, rate_rub AS rate, created_at, status
+    FROM orders
+    WHERE order_ref IS NOT NULL AND is_cancelled = FALSE AND status IN ('pending', 'paid')
+"""
+
+class OrderJournal:
+    def __init__(self, max_size, batch_size, interval, max_failures):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_failures = max_failures
+        self._queue = asyncio.Queue(max_size)
+        self._batch = []
+        self._task = None
+
+    def __len__(self):
+        return self._queue.qsize() + len(self._batch)
+
+    async def record_created(self, order):
+        await self._queue.put(('created', (
+            order.id, order.user_id, order.username, order.product_id, order.location_id,
+            order.price_rub, order.btc_amount, order.unique_satoshi, order.created_at, order.deadline,
+            order.rate
+        )))
+
+    async def record_status(self, order):
+        await self._queue.put(('status', (order.id, order.status, datetime.now())))
+
+    async def record_sale(self, order, received_amount):
+        await self._queue.put(('sale', (
+            datetime.now().date(), order.product_id, order.location_id, order.price_rub, received_amount
+        )))
+
+    def _fill_batch(self):
+        while len(self._batch) < self.batch_size and not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+
+    async def _write(self, entries):
+        # Вставки идут раньше обновлений: статус может прийти в той же пачке,
+        # что и сам заказ. Повтор пачки после ошибки безопасен
+        inserts = [args for kind, args in entries if kind == 'created']
+        updates = [args for kind, args in entries if kind == 'status']
+        sales = {}
+        for kind, args in entries:
+            if kind == 'sale':
+                day, product_id, location_id, price_rub, btc_amount = args
+                total = sales.setdefault((day, product_id, location_id), [0, Decimal(0), Decimal(0)])
+                total[0] += 1
+                total[1] += price_rub
+                total[2] += btc_amount
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                if inserts:
+                    with query_latency.time(statement_label(SQL_JOURNAL_INSERT)):
+                        await conn.executemany(SQL_JOURNAL_INSERT, inserts)
+                if updates:
+                    with query_latency.time(statement_label(SQL_JOURNAL_STATUS)):
+                        await conn.executemany(SQL_JOURNAL_STATUS, updates)
+                if sales:
+                    with query_latency.time(statement_label(SQL_SALES_UPSERT)):
+                        await conn.executemany(
+                            SQL_SALES_UPSERT, [key + tuple(total) for key, total in sales.items()]
+                        )
+
+    async def _write_batch(self):
+        await self._write(self._batch)
+        self._batch = []
+
+    async def _write_each(self):
+        # Пачка раз за разом не проходит: записи пишутся по одной, и те, что
+        # нарушают ограничения или типы, отбрасываются, чтобы не держать очередь.
+        # Прочие ошибки (например, база недоступна) прерывают проход без потерь
+        while self._batch:
+            entry = self._batch[0]
+            try:
+                await self._write([entry])
+            except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+                logger.error(f"Dropping order journal entry {entry}: {e}")
+            self._batch.pop(0)
+
+    async def _run(self):
+        failures = 0
+        while True:
+            if not self._batch:
+                self._batch.append(await self._queue.get())
+                # Короткая пауза, чтобы записи успели собраться в пачку
+                await asyncio.sleep(self.interval)
+            self._fill_batch()
+            try:
+                if failures < self.max_failures:
+                    await self._write_batch()
+                else:
+                    await self._write_each()
+                failures = 0
+            except Exception as e:
+                failures += 1
+                logger.error(f"Error writing {len(self._batch)} order journal entries: {e}")
+                await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        while self._batch or not self._queue.empty():
+            self._fill_batch()
+            try:
+                try:
+                    await self._write_batch()
+                except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError):
+                    await self._write_each()
+            except Exception as e:
+                logger.error(f"Order journal lost {len(self)} entries on shutdown: {e}")
+                return
+
+order_journal = OrderJournal(
+    ORDER_JOURNAL_QUEUE_SIZE, ORDER_JOURNAL_BATCH, ORDER_JOURNAL_INTERVAL, ORDER_JOURNAL_MAX_FAILURES
+)
+
+Gauge('bot_order_journal_backlog', 'Order journal entries waiting to be written', (), lambda: len(order_journal))
+
+async def finish_order_state(order):
+    state = dp.current_state(chat=order.user_id, user=order.user_id)
+    # Состояние сбрасывается, только если пользователь не начал новый заказ
+    if (await state.get_data()).get('order_id') == order.id:
+        await state.finish()
+
+class DeliveryFailed(Exception):
+    pass
+
+async def fulfill_order(order, received_amount):
+    if order.content_link is None:
+        order.content_link = await link_allocator.claim(order.location_id)
+    content_link = order.content_link
+    if content_link:
+        delivered = await outbox.send(
+            order.user_id,
+            f"Оплата подтверждена! Получено: {received_amount:.8f} BTC\n\n"
+            f"Ваша ссылка на контент:\n{content_link}"
+        )
+        if delivered is None:
+            # Заказ не считается выданным: ссылка остается за ним, выдача повторяется
+            raise DeliveryFailed(f"content link was not delivered, link {content_link}")
+        
+        # Уведомление администратора
+        outbox.notify_admins(
+            f"Новый заказ!\n"
+            f"Пользователь: @{order.username}\n"
+            f"Товар ID: {order.product_id}\n"
+            f"Локация ID: {order.location_id}\n"
+            f"Сумма: {received_amount:.8f} BTC\n"
+            f"Ссылка: {content_link}"
+        )
+    else:
+        await outbox.send(
+            order.user_id,
+            "Извините, в этой локации закончились доступные ссылки. "
+            "Мы вернем вам деньги в ближайшее время."
+        )
+    
+    await finish_order_state(order)
+    await set_main_menu(order.user_id)
+    return content_link is not None
+
+async def settle_order(order, received_amount, attempt=0):
+    deadline_scheduler.cancel(order.id)
+    if attempt == 0:
+        await order_journal.record_status(order)
+    try:
+        # В продажи идут только выданные заказы: без ссылки деньги возвращаются
+        if await fulfill_order(order, received_amount):
+            order.status = 'fulfilled'
+            await order_journal.record_status(order)
+            await order_journal.record_sale(order, received_amount)
+    except Exception as e:
+        # Оплаченный заказ не теряется: он остается отслеживаемым со статусом
+        # paid (и в журнале на случай перезапуска), выдача повторяется
+        delay = min(FULFIL_RETRY_INTERVAL * 2 ** attempt, FULFIL_RETRY_MAX_INTERVAL)
+        logger.error(f"Error fulfilling order {order.id} (attempt {attempt + 1}), retrying in {delay}s: {e}")
+        if attempt == 0:
+            outbox.alert_admins(
+                f"Не удалось выдать оплаченный заказ {order.id}!\n"
+                f"Пользователь: @{order.username}\n"
+                f"Сумма: {received_amount:.8f} BTC\n"
+                f"Ошибка: {e}\n"
+                f"Повтор через {delay} с."
+            )
+        deadline_scheduler.schedule(
+            order.id, datetime.now() + timedelta(seconds=delay),
+            functools.partial(retry_settle, attempt=attempt + 1)
+        )
+        return
+    payment_watcher.remove(order.id)
+
+async def retry_settle(order_id, attempt):
+    order = payment_watcher.get(order_id)
+    if order is not None and order.status == 'paid':
+        # Заказ сопоставляется по точной сумме, поэтому получено ровно amount_satoshi
+        await settle_order(order, satoshi_to_btc(order.amount_satoshi), attempt)
+
+def report_unmatched_payment(text):
+    logger.warning(text)
+    outbox.alert_admins(text)
+
+# Один фоновый опрос кошелька на всех ожидающих оплаты: запрашиваются только
+# новые транзакции, суммы сопоставляются с заказами по уникальной сумме в сатоши
+class PaymentWatcher:
+    def __init__(self, wallet, interval):
+        self.wallet = wallet
+        self.interval = interval
+        self.orders = {}
+        self._by_amount = {}
+        self._seen_txs = set()
+        self._cursor = None
+        self._task = None
+
+    def add(self, order):
+        self.orders[order.id] = order
+        self._by_amount[order.amount_satoshi] = order.id
+
+    def remove(self, order_id):
+        order = self.orders.pop(order_id, None)
+        if order is not None:
+            if self._by_amount.get(order.amount_satoshi) == order_id:
+                del self._by_amount[order.amount_satoshi]
+            tag_allocator.release(order.price_rub, order.unique_satoshi)
+            if shard is not None and owns_order(order):
+                shard.publish({'kind': 'order_removed', 'order_id': order_id})
+        return order
+
+    def is_amount_taken(self, amount_satoshi):
+        return amount_satoshi in self._by_amount
+
+    def get(self, order_id):
+        return self.orders.get(order_id)
+
+    def pop_expired(self, now):
+        expired = [
+            o for o in self.orders.values()
+            if o.status == 'pending' and o.deadline <= now and owns_order(o)
+        ]
+        for order in expired:
+            order.status = 'cancelled'
+            self.remove(order.id)
+        return expired
+
+    async def _fetch_txs(self, offset):
+        with external_latency.time('blockchain_rawaddr'):
+            async with http_session.get(
+                f'{BLOCKCHAIN_API_URL}rawaddr/{self.wallet}',
+                params={'limit': RAWADDR_PAGE_SIZE, 'offset': offset}
+            ) as response:
+                response.raise_for_status()
+                return await response.json(content_type=None)
+
+    async def _new_transactions(self):
+        data = await self._fetch_txs(0)
+        n_tx = data['n_tx']
+        txs = data['txs']
+        if self._cursor is None:
+            # Первый опрос (после запуска или простоя): листаем, пока не дойдем
+            # до транзакций старше самого раннего ожидающего заказа
+            oldest = min(o.created_at for o in self.orders.values()).timestamp()
+            while txs and txs[-1].get('time', 0) >= oldest and len(txs) < n_tx:
+                page = await self._fetch_txs(len(txs))
+                if not page['txs']:
+                    break
+                txs.extend(page['txs'])
+            txs = [tx for tx in txs if tx.get('time', 0) >= oldest]
+        else:
+            new_count = n_tx - self._cursor
+            while len(txs) < new_count:
+                page = await self._fetch_txs(len(txs))
+                if not page['txs']:
+                    break
+                txs.extend(page['txs'])
+            txs = txs[:max(new_count, 0)]
+        self._cursor = n_tx
+        return txs
+
+    def _received_satoshi(self, tx):
+        return sum(out.get('value', 0) for out in tx.get('out', []) if out.get('addr') == self.wallet)
+
+    async def poll(self):
+        if not self.orders:
+            # Без ожидающих заказов внешний API не опрашивается
+            self._cursor = None
+            self._seen_txs.clear()
+            return
+        
+        # При первом опросе просматриваются и уже учтенные до перезапуска
+        # транзакции, поэтому о платежах без заказа сообщается только в обычном режиме
+        catching_up = self._cursor is None
+        for tx in await self._new_transactions():
+            if tx['hash'] in self._seen_txs:
+                continue
+            self._seen_txs.add(tx['hash'])
+            
+            received_satoshi = self._received_satoshi(tx)
+            if not received_satoshi:
+                continue
+            order = self.orders.get(self._by_amount.get(received_satoshi))
+            if order is None or order.status != 'pending':
+                text = (
+                    f"Платеж без ожидающего заказа: {satoshi_to_btc(received_satoshi):.8f} BTC, "
+                    f"транзакция {tx['hash']}"
+                )
+                if catching_up:
+                    logger.warning(text)
+                else:
+                    report_unmatched_payment(text)
+                continue
+            
+            order.status = 'paid'
+            logger.info(f"Order {order.id} paid by transaction {tx['hash']}")
+            if owns_order(order):
+                await settle_order(order, satoshi_to_btc(received_satoshi))
+            else:
+                # Выдачу выполняет процесс, которому принадлежит пользователь
+                shard.publish({
+                    'kind': 'order_paid',
+                    'order_id': order.id,
+                    'received_satoshi': received_satoshi,
+                }, target=shard.order_owner(order))
+
+    async def _run(self):
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                logger.error(f"Error polling wallet transactions: {e}")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+payment_watcher = PaymentWatcher(BITCOIN_WALLET, PAYMENT_POLL_INTERVAL)
+
+Gauge('bot_pending_orders', 'Orders waiting for payment', (), lambda: len(payment_watcher.orders))
+
+# Кэш каталога: категории и локации загружаются целиком, товары - постранично
+# по мере просмотра. Сбрасывается админскими обработчиками, TTL - на случай правок прямо в базе
+class CatalogCache:
+    def __init__(self, ttl, page_size):
+        self.ttl = ttl
+        self.page_size = page_size
+        self.version = 0
+        self.loaded_at = None
+        self.categories = []
+        self.locations = []
+        self.categories_keyboard = None
+        self.location_names = {}
+        self._products = {}
+        self._product_pages = {}
+        self._available_locations = []
+        self._available_ids = []
+        self._location_pages = {}
+        self._stock_version = None
+        self._lock = asyncio.Lock()
 
-# Глобальные переменные для кэширования
-bitcoin_rate = None
-rate_last_updated = None
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
 
-# Утилиты
-async def get_bitcoin_rate():
-    global bitcoin_rate, rate_last_updated
-    
-    if rate_last_updated is None or (datetime.now() - rate_last_updated).seconds > 300:
-        try:
-            response = requests.get(f'{BLOCKCHAIN_API_URL}ticker')
-            response.raise_for_status()
-            data = response.json()
-            bitcoin_rate = Decimal(data['RUB']['last'])
-            rate_last_updated = datetime.now()
-            logger.info(f"Updated Bitcoin rate: {bitcoin_rate} RUB")
-        except Exception as e:
-            logger.error(f"Error updating Bitcoin rate: {e}")
-            if bitcoin_rate is None:
-                bitcoin_rate = Decimal('3000000')
-    return bitcoin_rate
+    async def load(self):
+        async with db_pool.acquire() as conn:
+            categories = await conn.fetch(SQL_ACTIVE_CATEGORIES)
+            locations = await conn.fetch(SQL_ACTIVE_LOCATIONS)
+        
+        categories_keyboard = types.InlineKeyboardMarkup(row_width=2)
+        for category in categories:
+            categories_keyboard.add(types.InlineKeyboardButton(
+                text=category['name'],
+                callback_data=CB_CATEGORY.pack(category['id'])
+            ))
+        
+        self.categories = categories
+        self.locations = locations
+        self.location_names = {location['id']: location['name'] for location in locations}
+        self.categories_keyboard = categories_keyboard
+        self._products = {}
+        self._product_pages = {}
+        self._stock_version = None
+        self.loaded_at = time.monotonic()
+        self.version += 1
+        logger.info(
+            f"Catalog loaded (version {self.version}): {len(categories)} categories, "
+            f"{len(locations)} locations"
+        )
 
-def satoshi_to_btc(satoshi):
-    return Decimal(satoshi) / Decimal('1e8')
+    async def ensure_fresh(self):
+        if self.is_fresh():
+            return
+        async with self._lock:
+            if not self.is_fresh():
+                await self.load()
 
-def generate_unique_satoshi():
-    return random.randint(1, 300)
+    def invalidate(self):
+        self.loaded_at = None
 
-async def convert_rub_to_btc(rub_amount):
-    rate = await get_bitcoin_rate()
-    btc_amount = Decimal(rub_amount) / rate
-    unique_satoshi = generate_unique_satoshi()
-    btc_amount += satoshi_to_btc(unique_satoshi)
-    return btc_amount, unique_satoshi
+    @staticmethod
+    def _page_keyboard(buttons, prev_data, next_data):
+        keyboard = types.InlineKeyboardMarkup(row_width=1)
+        for text, callback_data in buttons:
+            keyboard.add(types.InlineKeyboardButton(text=text, callback_data=callback_data))
+        navigation = []
+        if prev_data:
+            navigation.append(types.InlineKeyboardButton(text="« Назад", callback_data=prev_data))
+        if next_data:
+            navigation.append(types.InlineKeyboardButton(text="Далее »", callback_data=next_data))
+        if navigation:
+            keyboard.row(*navigation)
+        return keyboard
 
-async def check_payment(btc_address, expected_btc):
-    try:
-        response = requests.get(f'{BLOCKCHAIN_API_URL}rawaddr/{btc_address}')
-        response.raise_for_status()
-        data = response.json()
+    async def product_page(self, category_id, cursor=0, backward=False):
+        # Курсор - id крайнего товара соседней страницы: вперед листают
+        # от последнего, назад - от первого. Лишняя строка в LIMIT
+        # показывает, есть ли что-то дальше в направлении листания
+        key = (category_id, cursor, backward)
+        if key in self._product_pages:
+            return self._product_pages[key]
         
-        total_received = satoshi_to_btc(data['total_received'])
-        if total_received >= expected_btc:
-            return True, total_received
-        return False, total_received
-    except Exception as e:
-        logger.error(f"Error checking payment: {e}")
-        return False, Decimal('0')
+        query = SQL_PRODUCT_PAGE_BEFORE if backward else SQL_PRODUCT_PAGE_AFTER
+        rows = await db_fetch(query, category_id, cursor, self.page_size + 1)
+        has_more = len(rows) > self.page_size
+        rows = rows[:self.page_size]
+        if backward:
+            if not rows:
+                # Предыдущие товары сняли с продажи - возвращаемся в начало
+                return await self.product_page(category_id)
+            rows.reverse()
+            has_prev, has_next = has_more, True
+        else:
+            has_prev, has_next = cursor > 0, has_more
+        
+        keyboard = None
+        if rows:
+            keyboard = self._page_keyboard(
+                [
+                    (f"{product['name']} - {product['price_rub']} RUB", CB_PRODUCT.pack(product['id']))
+                    for product in rows
+                ],
+                CB_PRODUCT_PAGE.pack(category_id, rows[0]['id'], True) if has_prev else None,
+                CB_PRODUCT_PAGE.pack(category_id, rows[-1]['id'], False) if has_next else None,
+            )
+        self._product_pages[key] = keyboard
+        return keyboard
 
-async def get_available_link(location_id):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("""
-                SELECT id, content_link 
-                FROM location_links 
-                WHERE location_id = %s AND is_used = FALSE 
-                LIMIT 1
-                FOR UPDATE SKIP LOCKED
-            """, (location_id,))
-            link = cursor.fetchone()
-            
-            if link:
-                cursor.execute("""
-                    UPDATE location_links 
-                    SET is_used = TRUE 
-                    WHERE id = %s
-                """, (link['id'],))
-                conn.commit()
-                return link['content_link']
-            return None
-    finally:
-        conn.close()
+    async def product(self, product_id):
+        if product_id not in self._products:
+            self._products[product_id] = await db_fetchrow(SQL_PRODUCT, product_id)
+        return self._products[product_id]
+
+    def location_keyboard(self, product_id, cursor=0, backward=False):
+        # Распроданные локации скрываются; страницы перестраиваются,
+        # только когда меняется набор локаций в наличии
+        if self._stock_version != link_allocator.version:
+            self._available_locations = [
+                location for location in self.locations
+                if link_allocator.available(location['id']) > 0
+            ]
+            self._available_ids = [location['id'] for location in self._available_locations]
+            self._location_pages = {}
+            self._stock_version = link_allocator.version
+        
+        key = (product_id, cursor, backward)
+        if key not in self._location_pages:
+            if backward:
+                end = bisect.bisect_left(self._available_ids, cursor)
+                start = max(0, end - self.page_size)
+                end = start + self.page_size
+            else:
+                start = bisect.bisect_right(self._available_ids, cursor)
+                end = start + self.page_size
+            locations = self._available_locations[start:end]
+            keyboard = None
+            if locations:
+                keyboard = self._page_keyboard(
+                    [
+                        (location['name'], CB_LOCATION.pack(product_id, location['id']))
+                        for location in locations
+                    ],
+                    CB_LOCATION_PAGE.pack(product_id, locations[0]['id'], True) if start > 0 else None,
+                    CB_LOCATION_PAGE.pack(product_id, locations[-1]['id'], False)
+                    if end < len(self._available_ids) else None,
+                )
+            self._location_pages[key] = keyboard
+        return self._location_pages[key]
+
+catalog = CatalogCache(CATALOG_TTL, CATALOG_PAGE_SIZE)
 
 # Меню
 async def set_main_menu(user_id):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     buttons = ["Каталог", "О магазине", "Курс Bitcoin"]
     markup.add(*buttons)
-    await bot.send_message(user_id, "Главное меню:", reply_markup=markup)
+    await outbox.send(user_id, "Главное меню:", reply_markup=markup)
 
 async def set_admin_menu(user_id):
     markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
     buttons = [
         "Добавить категорию", "Добавить товар",
         "Добавить локацию", "Редактировать информацию",
+        "Импорт из файла", "Статистика",
         "Выйти из админки"
     ]
     markup.add(*buttons)
-    await bot.send_message(user_id, "Админ меню:", reply_markup=markup)
+    await outbox.send(user_id, "Админ меню:", reply_markup=markup)
 
 # Команды для пользователей
 @dp.message_handler(commands=['start', 'help'])
@@ -163,220 +2090,243 @@ async def cmd_start(message: types.Message):
         await set_admin_menu(message.from_user.id)
     else:
         await set_main_menu(message.from_user.id)
-    await message.answer("Добро пожаловать в наш магазин!")
+    await outbox.send(message.chat.id, "Добро пожаловать в наш магазин!")
 
 @dp.message_handler(text="Каталог")
+@timed_handler
 async def cmd_categories(message: types.Message):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("SELECT id, name FROM categories WHERE is_active = TRUE")
-            categories = cursor.fetchall()
-            
-            if not categories:
-                await message.answer("Категории товаров временно отсутствуют.")
-                return
-            
-            keyboard = types.InlineKeyboardMarkup(row_width=2)
-            for category in categories:
-                keyboard.add(types.InlineKeyboardButton(
-                    text=category['name'],
-                    callback_data=f"category_{category['id']}"
-                ))
-            
-            await message.answer("Выберите категорию:", reply_markup=keyboard)
-    finally:
-        conn.close()
+    await catalog.ensure_fresh()
+    
+    if not catalog.categories:
+        await outbox.send(message.chat.id, "Категории товаров временно отсутствуют.")
+        return
+    
+    await outbox.send(message.chat.id, "Выберите категорию:", reply_markup=catalog.categories_keyboard)
 
 @dp.message_handler(text="О магазине")
+@timed_handler
 async def cmd_about(message: types.Message):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("SELECT about_text FROM shop_info LIMIT 1")
-            about_text = cursor.fetchone()['about_text']
-            await message.answer(about_text)
-    finally:
-        conn.close()
+    about_text = await db_fetchval(SQL_SHOP_INFO)
+    await outbox.send(message.chat.id, about_text)
 
 @dp.message_handler(text="Курс Bitcoin")
+@timed_handler
 async def cmd_rate(message: types.Message):
-    rate = await get_bitcoin_rate()
-    await message.answer(f"Текущий курс Bitcoin: {rate:.2f} RUB")
-
-@dp.callback_query_handler(lambda c: c.data.startswith('category_'))
-async def process_category(callback_query: types.CallbackQuery):
-    category_id = int(callback_query.data.split('_')[1])
-    conn = get_db_connection()
     try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("""
-                SELECT id, name, description, price_rub 
-                FROM products 
-                WHERE category_id = %s AND is_active = TRUE
-            """, (category_id,))
-            products = cursor.fetchall()
-            
-            if not products:
-                await bot.answer_callback_query(callback_query.id, "В этой категории нет товаров.")
-                return
-            
-            keyboard = types.InlineKeyboardMarkup(row_width=1)
-            for product in products:
-                keyboard.add(types.InlineKeyboardButton(
-                    text=f"{product['name']} - {product['price_rub']} RUB",
-                    callback_data=f"product_{product['id']}"
-                ))
-            
-            await bot.send_message(
-                callback_query.from_user.id,
-                "Выберите товар:",
-                reply_markup=keyboard
-            )
-    finally:
-        conn.close()
-        await bot.answer_callback_query(callback_query.id)
+        rate = get_bitcoin_rate()
+    except RateUnavailable:
+        await outbox.send(message.chat.id, "Курс Bitcoin временно недоступен.")
+        return
+    await outbox.send(message.chat.id, f"Текущий курс Bitcoin: {rate:.2f} RUB")
 
-@dp.callback_query_handler(lambda c: c.data.startswith('product_'))
-async def process_product(callback_query: types.CallbackQuery, state: FSMContext):
-    product_id = int(callback_query.data.split('_')[1])
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("""
-                SELECT p.id, p.name, p.description, p.price_rub, c.name as category_name
-                FROM products p
-                JOIN categories c ON p.category_id = c.id
-                WHERE p.id = %s
-            """, (product_id,))
-            product = cursor.fetchone()
-            
-            if not product:
-                await bot.answer_callback_query(callback_query.id, "Товар не найден.")
-                return
-            
-            cursor.execute("SELECT id, name FROM locations WHERE is_active = TRUE")
-            locations = cursor.fetchall()
-            
-            if not locations:
-                await bot.answer_callback_query(callback_query.id, "Нет доступных локаций.")
-                return
-            
-            keyboard = types.InlineKeyboardMarkup(row_width=1)
-            for location in locations:
-                keyboard.add(types.InlineKeyboardButton(
-                    text=location['name'],
-                    callback_data=f"location_{product_id}_{location['id']}"
-                ))
-            
-            await state.update_data(product_id=product_id, price_rub=product['price_rub'])
-            await OrderStates.selecting_location.set()
-            
-            await bot.send_message(
-                callback_query.from_user.id,
-                f"Товар: {product['name']}\n"
-                f"Категория: {product['category_name']}\n"
-                f"Описание: {product['description']}\n"
-                f"Цена: {product['price_rub']} RUB\n\n"
-                "Выберите локацию:",
-                reply_markup=keyboard
-            )
-    finally:
-        conn.close()
-        await bot.answer_callback_query(callback_query.id)
+# Кнопки разбираются одним обработчиком: код действия ищется в таблице
+# маршрутов, вместо перебора фильтров по всем обработчикам
+callback_routes = {}
+
+def callback_route(action, state=None):
+    def decorator(handler):
+        callback_routes[action.code] = (handler, state.state if state is not None else None)
+        return handler
+    return decorator
+
+@dp.callback_query_handler(state='*')
+async def route_callback(callback_query: types.CallbackQuery, state: FSMContext):
+    decoded = unpack_callback(callback_query.data)
+    if decoded is not None:
+        action, fields = decoded
+        handler, required_state = callback_routes[action.code]
+        if required_state is None or await state.get_state() == required_state:
+            await handler(callback_query, state, **fields)
+            return
+    await bot.answer_callback_query(callback_query.id, "Кнопка устарела, откройте меню заново.")
+
+@callback_route(CB_CATEGORY)
+@timed_handler
+async def process_category(callback_query: types.CallbackQuery, state: FSMContext, category_id):
+    await catalog.ensure_fresh()
+    keyboard = await catalog.product_page(category_id)
+    
+    if keyboard is None:
+        await bot.answer_callback_query(callback_query.id, "В этой категории нет товаров.")
+        return
+    
+    await outbox.send(
+        callback_query.from_user.id,
+        "Выберите товар:",
+        reply_markup=keyboard
+    )
+    await bot.answer_callback_query(callback_query.id)
+
+async def show_page(callback_query, keyboard):
+    # Листание меняет клавиатуру у того же сообщения, а не шлет новое
+    if keyboard is None:
+        await bot.answer_callback_query(callback_query.id, "Список изменился, откройте его заново.")
+        return
+    await bot.edit_message_reply_markup(
+        callback_query.message.chat.id,
+        callback_query.message.message_id,
+        reply_markup=keyboard
+    )
+    await bot.answer_callback_query(callback_query.id)
+
+@callback_route(CB_PRODUCT_PAGE)
+@timed_handler
+async def process_product_page(callback_query: types.CallbackQuery, state: FSMContext, category_id, cursor, backward):
+    await catalog.ensure_fresh()
+    keyboard = await catalog.product_page(category_id, cursor, bool(backward))
+    await show_page(callback_query, keyboard)
+
+@callback_route(CB_PRODUCT)
+@timed_handler
+async def process_product(callback_query: types.CallbackQuery, state: FSMContext, product_id):
+    await catalog.ensure_fresh()
+    product = await catalog.product(product_id)
+    
+    if not product:
+        await bot.answer_callback_query(callback_query.id, "Товар не найден.")
+        return
+    
+    keyboard = catalog.location_keyboard(product_id)
+    
+    if keyboard is None:
+        await bot.answer_callback_query(callback_query.id, "Нет доступных локаций.")
+        return
+    
+    await state.update_data(product_id=product_id, price_rub=product['price_rub'])
+    await OrderStates.selecting_location.set()
+    
+    await outbox.send(
+        callback_query.from_user.id,
+        f"Товар: {product['name']}\n"
+        f"Категория: {product['category_name']}\n"
+        f"Описание: {product['description']}\n"
+        f"Цена: {product['price_rub']} RUB\n\n"
+        "Выберите локацию:",
+        reply_markup=keyboard
+    )
+    await bot.answer_callback_query(callback_query.id)
+
+async def is_current_product(callback_query, state, product_id):
+    # Цена в состоянии относится к последнему открытому товару: кнопки локаций
+    # из клавиатуры другого товара устарели
+    if (await state.get_data()).get('product_id') == product_id:
+        return True
+    await bot.answer_callback_query(callback_query.id, "Эта кнопка устарела, откройте товар заново.")
+    return False
+
+@callback_route(CB_LOCATION_PAGE, state=OrderStates.selecting_location)
+@timed_handler
+async def process_location_page(callback_query: types.CallbackQuery, state: FSMContext, product_id, cursor, backward):
+    if not await is_current_product(callback_query, state, product_id):
+        return
+    await catalog.ensure_fresh()
+    keyboard = catalog.location_keyboard(product_id, cursor, bool(backward))
+    await show_page(callback_query, keyboard)
 
-@dp.callback_query_handler(lambda c: c.data.startswith('location_'), state=OrderStates.selecting_location)
-async def process_location(callback_query: types.CallbackQuery, state: FSMContext):
-    _, product_id, location_id = callback_query.data.split('_')
-    product_id = int(product_id)
-    location_id = int(location_id)
+@callback_route(CB_LOCATION, state=OrderStates.selecting_location)
+@timed_handler
+async def process_location(callback_query: types.CallbackQuery, state: FSMContext, product_id, location_id):
+    if not await is_current_product(callback_query, state, product_id):
+        return
+    if link_allocator.available(location_id) <= 0:
+        await bot.answer_callback_query(callback_query.id, "В этой локации товар закончился.")
+        return
+    
+    try:
+        rate = get_bitcoin_rate()
+    except RateUnavailable:
+        await bot.answer_callback_query(callback_query.id, "Курс Bitcoin временно недоступен, попробуйте через минуту.")
+        return
     
     user_data = await state.get_data()
     price_rub = user_data['price_rub']
+    # Предыдущий неоплаченный заказ пользователя заменяется новым
+    previous = payment_watcher.remove(user_data.get('order_id'))
+    deadline_scheduler.cancel(user_data.get('order_id'))
+    if previous is not None and previous.status == 'pending':
+        previous.status = 'cancelled'
+        await order_journal.record_status(previous)
     
-    btc_amount, unique_satoshi = await convert_rub_to_btc(price_rub)
+    # Курс фиксируется в заказе на все окно оплаты
+    btc_amount, unique_satoshi = convert_rub_to_btc(price_rub, rate)
+    order = Order(
+        id=uuid.uuid4().hex[:12],
+        user_id=callback_query.from_user.id,
+        username=callback_query.from_user.username,
+        product_id=product_id,
+        location_id=location_id,
+        price_rub=Decimal(price_rub),
+        btc_amount=btc_amount,
+        unique_satoshi=unique_satoshi,
+        rate=rate,
+        created_at=datetime.now()
+    )
+    payment_watcher.add(order)
+    deadline_scheduler.schedule(order.id, order.deadline, expire_pending_order)
+    await order_journal.record_created(order)
+    if shard is not None:
+        shard.publish({'kind': 'order_added', 'order': asdict(order)})
     
     await state.update_data(
+        order_id=order.id,
         product_id=product_id,
         location_id=location_id,
         btc_amount=btc_amount,
         unique_satoshi=unique_satoshi,
-        order_time=datetime.now()
+        order_time=order.created_at
     )
     
     await OrderStates.waiting_payment.set()
     
-    await bot.send_message(
+    await outbox.send(
         callback_query.from_user.id,
         f"Пожалуйста, отправьте {btc_amount:.8f} BTC на адрес:\n"
         f"`{BITCOIN_WALLET}`\n\n"
-        f"Уникальный идентификатор платежа: {unique_satoshi} сатоши\n\n"
-        "После оплаты нажмите кнопку 'Проверить оплату'.",
+        f"Уникальный идентификатор платежа: {unique_satoshi} сатоши\n"
+        f"Курс {rate:.2f} RUB зафиксирован до {order.deadline:%H:%M}\n\n"
+        "Мы пришлем ссылку автоматически, как только оплата поступит. "
+        "Проверить статус можно кнопкой 'Проверить оплату'.",
         parse_mode='Markdown',
         reply_markup=types.InlineKeyboardMarkup().add(
             types.InlineKeyboardButton(
                 text="Проверить оплату",
-                callback_data="check_payment"
+                callback_data=CB_CHECK_PAYMENT.pack()
             )
         )
     )
     await bot.answer_callback_query(callback_query.id)
 
-@dp.callback_query_handler(lambda c: c.data == 'check_payment', state=OrderStates.waiting_payment)
+@callback_route(CB_CHECK_PAYMENT, state=OrderStates.waiting_payment)
+@timed_handler
 async def check_payment_handler(callback_query: types.CallbackQuery, state: FSMContext):
     user_data = await state.get_data()
-    btc_amount = user_data['btc_amount']
-    unique_satoshi = user_data['unique_satoshi']
-    
-    is_paid, received_amount = await check_payment(BITCOIN_WALLET, btc_amount)
-    
-    if is_paid:
-        content_link = await get_available_link(user_data['location_id'])
-        if content_link:
-            await bot.send_message(
-                callback_query.from_user.id,
-                f"Оплата подтверждена! Получено: {received_amount:.8f} BTC\n\n"
-                f"Ваша ссылка на контент:\n{content_link}"
-            )
-            
-            # Уведомление администратора
-            for admin_id in ADMIN_IDS:
-                try:
-                    await bot.send_message(
-                        admin_id,
-                        f"Новый заказ!\n"
-                        f"Пользователь: @{callback_query.from_user.username}\n"
-                        f"Товар ID: {user_data['product_id']}\n"
-                        f"Локация ID: {user_data['location_id']}\n"
-                        f"Сумма: {received_amount:.8f} BTC\n"
-                        f"Ссылка: {content_link}"
-                    )
-                except Exception as e:
-                    logger.error(f"Error notifying admin {admin_id}: {e}")
-            
-            await state.finish()
-            await set_main_menu(callback_query.from_user.id)
-        else:
-            await bot.send_message(
-                callback_query.from_user.id,
-                "Извините, в этой локации закончились доступные ссылки. "
-                "Мы вернем вам деньги в ближайшее время."
-            )
+    order = payment_watcher.get(user_data.get('order_id'))
+    # Заказ может отслеживать другой процесс: срок и сумма берутся из состояния
+    deadline = user_data['order_time'] + ORDER_TTL
+    
+    if order is None and deadline <= datetime.now():
+        await state.finish()
+        await outbox.send(
+            callback_query.from_user.id,
+            "Заказ не найден или уже отменен. Пожалуйста, оформите заказ заново."
+        )
+        await set_main_menu(callback_query.from_user.id)
+    elif order is not None and order.status == 'paid':
+        await bot.answer_callback_query(callback_query.id, "Оплата подтверждена, ссылка уже отправляется.")
+        return
     else:
-        order_time = user_data['order_time']
-        time_left = timedelta(minutes=30) - (datetime.now() - order_time)
+        time_left = deadline - datetime.now()
         minutes_left = max(0, int(time_left.total_seconds() / 60))
         
-        await bot.send_message(
+        await outbox.send(
             callback_query.from_user.id,
-            f"Оплата не найдена. Ожидаемая сумма: {btc_amount:.8f} BTC\n"
-            f"Получено: {received_amount:.8f} BTC\n\n"
+            f"Оплата пока не найдена. Ожидаемая сумма: {user_data['btc_amount']:.8f} BTC\n\n"
             f"Оставшееся время для оплаты: {minutes_left} минут\n\n"
-            "Пожалуйста, попробуйте позже или свяжитесь с поддержкой.",
+            "Ссылка придет автоматически после поступления оплаты.",
             reply_markup=types.InlineKeyboardMarkup().add(
                 types.InlineKeyboardButton(
                     text="Проверить оплату",
-                    callback_data="check_payment"
+                    callback_data=CB_CHECK_PAYMENT.pack()
                 )
             )
         )
@@ -387,56 +2337,46 @@ async def check_payment_handler(callback_query: types.CallbackQuery, state: FSMC
 @dp.message_handler(text="Выйти из админки", user_id=ADMIN_IDS)
 async def exit_admin_mode(message: types.Message):
     await set_main_menu(message.from_user.id)
-    await message.answer("Вы вышли из админ-панели")
+    await outbox.send(message.chat.id, "Вы вышли из админ-панели")
 
 @dp.message_handler(text="Добавить категорию", user_id=ADMIN_IDS)
 async def admin_add_category(message: types.Message):
     await AdminStates.adding_category.set()
-    await message.answer("Введите название новой категории:", reply_markup=types.ReplyKeyboardRemove())
+    await outbox.send(message.chat.id, "Введите название новой категории:", reply_markup=types.ReplyKeyboardRemove())
 
 @dp.message_handler(state=AdminStates.adding_category, user_id=ADMIN_IDS)
 async def process_add_category(message: types.Message, state: FSMContext):
     category_name = message.text
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO categories (name, is_active) VALUES (%s, TRUE) RETURNING id",
-                (category_name,)
-            )
-            category_id = cursor.fetchone()[0]
-            conn.commit()
-            await message.answer(f"Категория '{category_name}' добавлена с ID: {category_id}")
-            await set_admin_menu(message.from_user.id)
+        category_id = await db_fetchval(
+            "INSERT INTO categories (name, is_active) VALUES ($1, TRUE) RETURNING id",
+            category_name
+        )
+        catalog.invalidate()
+        await outbox.send(message.chat.id, f"Категория '{category_name}' добавлена с ID: {category_id}")
+        await set_admin_menu(message.from_user.id)
     except Exception as e:
         logger.error(f"Error adding category: {e}")
-        await message.answer("Ошибка при добавлении категории.")
+        await outbox.send(message.chat.id, "Ошибка при добавлении категории.")
     finally:
-        conn.close()
         await state.finish()
 
 @dp.message_handler(text="Добавить товар", user_id=ADMIN_IDS)
-async def admin_add_product(message: types.Message):
-    conn = get_db_connection()
-    try:
-        with conn.cursor(cursor_factory=DictCursor) as cursor:
-            cursor.execute("SELECT id, name FROM categories WHERE is_active = TRUE")
-            categories = cursor.fetchall()
-            
-            if not categories:
-                await message.answer("Нет активных категорий. Сначала добавьте категорию.")
-                return
-            
-            markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
-            buttons = [f"Категория {c['id']}: {c['name']}" for c in categories]
-            markup.add(*buttons)
-            markup.add("Отмена")
-            
-            await AdminStates.adding_product.set()
-            await state.update_data(categories={c['id']: c['name'] for c in categories})
-            await message.answer("Выберите категорию для товара:", reply_markup=markup)
-    finally:
-        conn.close()
+async def admin_add_product(message: types.Message, state: FSMContext):
+    categories = await db_fetch(SQL_ACTIVE_CATEGORIES)
+    
+    if not categories:
+        await outbox.send(message.chat.id, "Нет активных категорий. Сначала добавьте категорию.")
+        return
+    
+    markup = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    buttons = [f"Категория {c['id']}: {c['name']}" for c in categories]
+    markup.add(*buttons)
+    markup.add("Отмена")
+    
+    await AdminStates.adding_product.set()
+    await state.update_data(categories={c['id']: c['name'] for c in categories})
+    await outbox.send(message.chat.id, "Выберите категорию для товара:", reply_markup=markup)
 
 @dp.message_handler(state=AdminStates.adding_product, user_id=ADMIN_IDS)
 async def process_add_product_step1(message: types.Message, state: FSMContext):
@@ -450,11 +2390,11 @@ async def process_add_product_step1(message: types.Message, state: FSMContext):
             break
     
     if category_selected is None:
-        await message.answer("Пожалуйста, выберите категорию из списка.")
+        await outbox.send(message.chat.id, "Пожалуйста, выберите категорию из списка.")
         return
     
     await state.update_data(category_id=category_selected)
-    await message.answer(
+    await outbox.send(message.chat.id, 
         "Введите данные товара в формате:\n"
         "Название|Описание|Цена в RUB\n\n"
         "Пример:\n"
@@ -471,115 +2411,874 @@ async def process_add_product_step2(message: types.Message, state: FSMContext):
         user_data = await state.get_data()
         category_id = user_data['category_id']
         
-        conn = get_db_connection()
-        try:
-            with conn.cursor() as cursor:
-                cursor.execute("""
-                    INSERT INTO products (name, description, price_rub, category_id, is_active)
-                    VALUES (%s, %s, %s, %s, TRUE)
-                    RETURNING id
-                """, (name.strip(), description.strip(), price_rub, category_id))
-                product_id = cursor.fetchone()[0]
-                conn.commit()
-                await message.answer(f"Товар '{name}' добавлен с ID: {product_id}")
-                await set_admin_menu(message.from_user.id)
-        finally:
-            conn.close()
+        product_id = await db_fetchval("""
+            INSERT INTO products (name, description, price_rub, category_id, is_active)
+            VALUES ($1, $2, $3, $4, TRUE)
+            RETURNING id
+        """, name.strip(), description.strip(), price_rub, category_id)
+        catalog.invalidate()
+        await outbox.send(message.chat.id, f"Товар '{name}' добавлен с ID: {product_id}")
+        await set_admin_menu(message.from_user.id)
     except Exception as e:
         logger.error(f"Error adding product: {e}")
-        await message.answer("Неверный формат данных. Пожалуйста, попробуйте снова.")
+        await outbox.send(message.chat.id, "Неверный формат данных. Пожалуйста, попробуйте снова.")
     finally:
         await state.finish()
 
 @dp.message_handler(text="Добавить локацию", user_id=ADMIN_IDS)
 async def admin_add_location(message: types.Message):
     await AdminStates.adding_location.set()
-    await message.answer("Введите название новой локации:", reply_markup=types.ReplyKeyboardRemove())
+    await outbox.send(message.chat.id, "Введите название новой локации:", reply_markup=types.ReplyKeyboardRemove())
 
 @dp.message_handler(state=AdminStates.adding_location, user_id=ADMIN_IDS)
 async def process_add_location(message: types.Message, state: FSMContext):
     location_name = message.text
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "INSERT INTO locations (name, is_active) VALUES (%s, TRUE) RETURNING id",
-                (location_name,)
-            )
-            location_id = cursor.fetchone()[0]
-            conn.commit()
-            await message.answer(f"Локация '{location_name}' добавлена с ID: {location_id}")
-            await set_admin_menu(message.from_user.id)
+        location_id = await db_fetchval(
+            "INSERT INTO locations (name, is_active) VALUES ($1, TRUE) RETURNING id",
+            location_name
+        )
+        catalog.invalidate()
+        await outbox.send(message.chat.id, f"Локация '{location_name}' добавлена с ID: {location_id}")
+        await set_admin_menu(message.from_user.id)
     except Exception as e:
         logger.error(f"Error adding location: {e}")
-        await message.answer("Ошибка при добавлении локации.")
+        await outbox.send(message.chat.id, "Ошибка при добавлении локации.")
     finally:
-        conn.close()
         await state.finish()
 
+# Массовый импорт товаров и ссылок из файла
+LINK_COLUMNS = ('location_id', 'content_link')
+PRODUCT_COLUMNS = ('category_id', 'name', 'description', 'price_rub')
+
+# Ссылки, которые уже есть в location_links, не загружаются повторно: иначе
+# повторная загрузка файла удвоила бы запас и одна ссылка продалась бы дважды
+SQL_IMPORT_LINKS_TABLE = """
+    CREATE TEMP TABLE import_links (
+        location_id INTEGER, content_link TEXT, is_used BOOLEAN
+    ) ON COMMIT DROP
+"""
+SQL_IMPORT_NEW_LINKS = """
+    INSERT INTO location_links (location_id, content_link, is_used)
+    SELECT i.location_id, i.content_link, i.is_used FROM import_links i
+    WHERE NOT EXISTS (SELECT 1 FROM location_links l WHERE l.content_link = i.content_link)
+    RETURNING content_link
+"""
+
+def _parse_link_row(row, location_ids):
+    location_id, content_link = int(row[0]), row[1].strip()
+    if location_id not in location_ids:
+        raise ValueError(f"неизвестная локация {location_id}")
+    if not content_link:
+        raise ValueError("пустая ссылка")
+    parts = urlsplit(content_link)
+    if parts.scheme not in ('http', 'https') or not parts.netloc or any(c.isspace() for c in content_link):
+        raise ValueError(f"неверная ссылка {content_link[:50]}")
+    return location_id, content_link, False
+
+def _parse_product_row(row, category_ids):
+    category_id, name, description = int(row[0]), row[1].strip(), row[2].strip()
+    price_rub = Decimal(row[3].strip())
+    if category_id not in category_ids:
+        raise ValueError(f"неизвестная категория {category_id}")
+    if not name:
+        raise ValueError("пустое название")
+    if price_rub <= 0:
+        raise ValueError("цена должна быть больше нуля")
+    return name, description, price_rub, category_id, True
+
+def read_import_rows(buffer, caption):
+    text = io.TextIOWrapper(buffer, encoding='utf-8-sig', newline='')
+    first_line = text.readline()
+    # Текстовый файл: по ссылке на строку, ID локации в подписи к файлу
+    if caption and caption.strip().isdigit():
+        location_id = caption.strip()
+        lines = itertools.chain([first_line], text)
+        return 'links', ([location_id, line.strip()] for line in lines)
+    
+    dialect = csv.Sniffer().sniff(first_line, delimiters=',;\t')
+    header = tuple(column.strip().lower() for column in next(csv.reader([first_line], dialect)))
+    if header == LINK_COLUMNS:
+        return 'links', csv.reader(text, dialect)
+    if header == PRODUCT_COLUMNS:
+        return 'products', csv.reader(text, dialect)
+    raise ValueError(f"неизвестный заголовок: {', '.join(header)}")
+
+async def import_file(buffer, caption):
+    kind, rows = read_import_rows(buffer, caption)
+    if kind == 'links':
+        known_ids = {row['id'] for row in await db_fetch("SELECT id FROM locations")}
+        parse_row, columns, table = _parse_link_row, ('location_id', 'content_link', 'is_used'), 'location_links'
+        size = len(LINK_COLUMNS)
+    else:
+        known_ids = {row['id'] for row in await db_fetch("SELECT id FROM categories")}
+        parse_row, table = _parse_product_row, 'products'
+        columns = ('name', 'description', 'price_rub', 'category_id', 'is_active')
+        size = len(PRODUCT_COLUMNS)
+    
+    records, errors, seen = [], [], {}
+    # Нумерация с 2: первая строка файла - заголовок или первая ссылка
+    start = 1 if caption and caption.strip().isdigit() else 2
+    for line_number, row in enumerate(rows, start=start):
+        if not any(field.strip() for field in row):
+            continue
+        try:
+            if len(row) != size:
+                raise ValueError(f"ожидается столбцов: {size}")
+            record = parse_row(row, known_ids)
+            # Ссылка продается один раз, в какой бы локации она ни была
+            key = record[1] if kind == 'links' else record
+            if key in seen:
+                raise ValueError("повтор строки")
+        except (ValueError, InvalidOperation) as e:
+            errors.append(f"строка {line_number}: {e}")
+            continue
+        seen[key] = line_number
+        records.append(record)
+    
+    if records:
+        async with db_pool.acquire() as conn:
+            async with conn.transaction():
+                if kind == 'links':
+                    await conn.execute(SQL_IMPORT_LINKS_TABLE)
+                    await conn.copy_records_to_table('import_links', records=records, columns=columns)
+                    inserted = {row['content_link'] for row in await conn.fetch(SQL_IMPORT_NEW_LINKS)}
+                else:
+                    await conn.copy_records_to_table(table, records=records, columns=columns)
+        if kind == 'links' and len(inserted) < len(records):
+            for record in records:
+                if record[1] not in inserted:
+                    errors.append(f"строка {seen[record[1]]}: ссылка уже загружена")
+            records = [record for record in records if record[1] in inserted]
+    return kind, records, errors
+
+@dp.message_handler(text="Импорт из файла", user_id=ADMIN_IDS)
+async def admin_bulk_import(message: types.Message):
+    await AdminStates.bulk_import.set()
+    await outbox.send(
+        message.chat.id,
+        "Отправьте CSV-файл с заголовком:\n"
+        f"{','.join(PRODUCT_COLUMNS)} - для товаров\n"
+        f"{','.join(LINK_COLUMNS)} - для ссылок\n\n"
+        "Или текстовый файл со ссылками по одной на строку, указав ID локации в подписи к файлу.\n"
+        "Для выхода отправьте 'Отмена'.",
+        reply_markup=types.ReplyKeyboardRemove()
+    )
+
+@dp.message_handler(content_types=types.ContentType.DOCUMENT, state=AdminStates.bulk_import, user_id=ADMIN_IDS)
+async def process_bulk_import(message: types.Message, state: FSMContext):
+    try:
+        buffer = await bot.download_file_by_id(message.document.file_id)
+        buffer.seek(0)
+        kind, records, errors = await import_file(buffer, message.caption)
+    except Exception as e:
+        logger.error(f"Error importing file: {e}")
+        await outbox.send(message.chat.id, f"Ошибка импорта, данные не загружены: {e}")
+        return
+    
+    if kind == 'links':
+        for location_id, count in collections.Counter(record[0] for record in records).items():
+            link_allocator.adjust(location_id, count)
+        title = "Ссылок"
+    else:
+        catalog.invalidate()
+        title = "Товаров"
+    
+    logger.info(f"Imported {len(records)} {kind}, rejected {len(errors)} rows")
+    report = f"Импорт завершен.\n{title} добавлено: {len(records)}\nОтклонено строк: {len(errors)}"
+    if errors:
+        report += "\n\n" + "\n".join(errors[:IMPORT_ERROR_PREVIEW])
+        if len(errors) > IMPORT_ERROR_PREVIEW:
+            report += f"\n... и еще {len(errors) - IMPORT_ERROR_PREVIEW}"
+    await outbox.send(message.chat.id, report)
+    await state.finish()
+    await set_admin_menu(message.from_user.id)
+
+@dp.message_handler(state=AdminStates.bulk_import, user_id=ADMIN_IDS)
+async def process_bulk_import_text(message: types.Message, state: FSMContext):
+    if message.text == "Отмена":
+        await state.finish()
+        await set_admin_menu(message.from_user.id)
+        return
+    await outbox.send(message.chat.id, "Пожалуйста, отправьте файл или 'Отмена'.")
+
 @dp.message_handler(text="Редактировать информацию", user_id=ADMIN_IDS)
 async def admin_edit_shop_info(message: types.Message):
     await AdminStates.editing_shop_info.set()
-    await message.answer("Введите новый текст для раздела 'О магазине':", reply_markup=types.ReplyKeyboardRemove())
+    await outbox.send(message.chat.id, "Введите новый текст для раздела 'О магазине':", reply_markup=types.ReplyKeyboardRemove())
 
 @dp.message_handler(state=AdminStates.editing_shop_info, user_id=ADMIN_IDS)
 async def process_edit_shop_info(message: types.Message, state: FSMContext):
     new_text = message.text
-    conn = get_db_connection()
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(
-                "UPDATE shop_info SET about_text = %s, updated_at = NOW()",
-                (new_text,)
-            )
-            conn.commit()
-            await message.answer("Текст 'О магазине' успешно обновлен!")
-            await set_admin_menu(message.from_user.id)
+        await db_execute(
+            "UPDATE shop_info SET about_text = $1, updated_at = NOW()",
+            new_text
+        )
+        await outbox.send(message.chat.id, "Текст 'О магазине' успешно обновлен!")
+        await set_admin_menu(message.from_user.id)
     except Exception as e:
         logger.error(f"Error updating shop info: {e}")
-        await message.answer("Ошибка при обновлении информации.")
+        await outbox.send(message.chat.id, "Ошибка при обновлении информации.")
     finally:
-        conn.close()
         await state.finish()
 
+# Отчет по продажам читает только свертку sales_daily
+SQL_SALES_TOTALS = """
+    SELECT coalesce(sum(orders), 0) AS orders,
+           coalesce(sum(revenue_rub), 0) AS revenue_rub,
+           coalesce(sum(revenue_btc), 0) AS revenue_btc
+    FROM sales_daily
+    WHERE day >= $1
+"""
+SQL_SALES_TOP_PRODUCTS = """
+    SELECT s.product_id, p.name, sum(s.orders) AS orders, sum(s.revenue_rub) AS revenue_rub
+    FROM sales_daily s
+    LEFT JOIN products p ON p.id = s.product_id
+    WHERE s.day >= $1
+    GROUP BY s.product_id, p.name
+    ORDER BY revenue_rub DESC
+    LIMIT $2
+"""
+SQL_SALES_TOP_LOCATIONS = """
+    SELECT location_id, sum(orders) AS orders, sum(revenue_rub) AS revenue_rub
+    FROM sales_daily
+    WHERE day >= $1
+    GROUP BY location_id
+    ORDER BY revenue_rub DESC
+    LIMIT $2
+"""
+SALES_REPORT_PERIODS = (("Сегодня", 0), ("7 дней", 6), ("30 дней", 29))
+SALES_REPORT_TOP = 5
+
+@dp.message_handler(text="Статистика", user_id=ADMIN_IDS)
+@timed_handler
+async def admin_sales_report(message: types.Message):
+    today = datetime.now().date()
+    month_start = today - timedelta(days=SALES_REPORT_PERIODS[-1][1])
+    try:
+        *totals, top_products, top_locations = await asyncio.gather(
+            *(db_fetchrow(SQL_SALES_TOTALS, today - timedelta(days=days)) for _, days in SALES_REPORT_PERIODS),
+            db_fetch(SQL_SALES_TOP_PRODUCTS, month_start, SALES_REPORT_TOP),
+            db_fetch(SQL_SALES_TOP_LOCATIONS, month_start, SALES_REPORT_TOP)
+        )
+    except Exception as e:
+        logger.error(f"Error building sales report: {e}")
+        await outbox.send(message.chat.id, "Ошибка при формировании отчета.")
+        return
+    
+    lines = ["Продажи:"]
+    for (title, _), row in zip(SALES_REPORT_PERIODS, totals):
+        lines.append(
+            f"{title}: {row['orders']} заказов, {row['revenue_rub']} RUB, {row['revenue_btc']:.8f} BTC"
+        )
+    if top_products:
+        lines.append("\nТоп товаров за 30 дней:")
+        lines.extend(
+            f"{row['name'] or row['product_id']}: {row['orders']} шт., {row['revenue_rub']} RUB"
+            for row in top_products
+        )
+    if top_locations:
+        lines.append("\nТоп локаций за 30 дней:")
+        lines.extend(
+            f"{catalog.location_names.get(row['location_id'], row['location_id'])}: "
+            f"{row['orders']} шт., {row['revenue_rub']} RUB"
+            for row in top_locations
+        )
+    await outbox.send(message.chat.id, "\n".join(lines))
+
+# Рассылка уведомлений через очередь исходящих сообщений
+async def notify_users(messages):
+    await asyncio.gather(*(outbox.send(chat_id, text) for chat_id, text in messages))
+
+def expired_order_text(order_id):
+    return f"Ваш заказ #{order_id} был отменен, так как оплата не поступила в течение 30 минут."
+
+# Планировщик сроков: каждый заказ отменяется точно в момент истечения срока.
+# Отмененные записи помечаются и выбрасываются из кучи при извлечении
+class DeadlineScheduler:
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def schedule(self, key, deadline, callback):
+        self.cancel(key)
+        entry = [deadline.timestamp(), next(self._seq), key, callback]
+        self._entries[key] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    def cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            entry[3] = None
+
+    async def _fire(self, callback, key):
+        try:
+            await callback(key)
+        except Exception as e:
+            logger.error(f"Error running deadline for {key}: {e}")
+
+    async def _run(self):
+        while True:
+            while self._heap and self._heap[0][3] is None:
+                heapq.heappop(self._heap)
+            
+            timeout = None
+            if self._heap:
+                timeout = self._heap[0][0] - time.time()
+            if timeout is None or timeout > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            _, _, key, callback = heapq.heappop(self._heap)
+            del self._entries[key]
+            asyncio.create_task(self._fire(callback, key))
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+deadline_scheduler = DeadlineScheduler()
+
 # Проверка просроченных заказов
+# Запросы ниже касаются только строк без order_ref, созданных в обход журнала:
+# заказы журнала восстанавливаются в память и истекают там
+SQL_PENDING_ORDERS = """
+    SELECT id, user_id, created_at FROM orders
+    WHERE is_paid = FALSE AND is_cancelled = FALSE AND order_ref IS NULL
+"""
+SQL_CANCEL_ORDER = """
+    UPDATE orders SET is_cancelled = TRUE, status = 'cancelled'
+    WHERE id = $1 AND is_paid = FALSE AND is_cancelled = FALSE
+    RETURNING user_id
+"""
+# Страховочная проверка: все просроченные заказы отменяются одним запросом
+# по частичному индексу, уведомления отправляются после фиксации транзакции
+SQL_CANCEL_EXPIRED_ORDERS = """
+    UPDATE orders SET is_cancelled = TRUE, status = 'cancelled'
+    WHERE is_paid = FALSE AND is_cancelled = FALSE AND order_ref IS NULL AND created_at < $1
+    RETURNING id, user_id
+"""
+
+async def expire_pending_order(order_id):
+    order = payment_watcher.get(order_id)
+    if order is None or order.status != 'pending':
+        return
+    order.status = 'cancelled'
+    payment_watcher.remove(order_id)
+    await order_journal.record_status(order)
+    await finish_order_state(order)
+    await notify_users([(order.user_id, expired_order_text(order.id))])
+
+async def expire_db_order(order_id):
+    user_id = await db_fetchval(SQL_CANCEL_ORDER, order_id)
+    if user_id is not None:
+        await notify_users([(user_id, expired_order_text(order_id))])
+
+async def restore_pending_orders():
+    # Каждый процесс держит все заказы, как и при рассылке событий:
+    # кошелек опрашивает ведущий, а сроки ведет процесс-владелец
+    restored = 0
+    for row in await db_fetch(SQL_JOURNAL_PENDING):
+        payment_watcher.add(Order(**dict(row)))
+        restored += 1
+    logger.info(f"Restored {restored} pending orders from the journal")
+
+async def schedule_pending_orders():
+    orders = await db_fetch(SQL_PENDING_ORDERS)
+    for order in orders:
+        deadline_scheduler.schedule(order['id'], order['created_at'] + ORDER_TTL, expire_db_order)
+    for order in payment_watcher.orders.values():
+        if not owns_order(order):
+            continue
+        if order.status == 'paid':
+            deadline_scheduler.schedule(order.id, datetime.now(), functools.partial(retry_settle, attempt=1))
+        else:
+            deadline_scheduler.schedule(order.id, order.deadline, expire_pending_order)
+    logger.info(f"Scheduled {len(deadline_scheduler)} order deadlines")
+
+async def expire_orders():
+    expired = payment_watcher.pop_expired(datetime.now())
+    for order in expired:
+        deadline_scheduler.cancel(order.id)
+        await order_journal.record_status(order)
+        await finish_order_state(order)
+    messages = [(order.user_id, expired_order_text(order.id)) for order in expired]
+    
+    if not background_duties.active:
+        if messages:
+            await notify_users(messages)
+        return
+    
+    try:
+        cancelled = await db_fetch(SQL_CANCEL_EXPIRED_ORDERS, datetime.now() - ORDER_TTL)
+        for order in cancelled:
+            deadline_scheduler.cancel(order['id'])
+        messages.extend((order['user_id'], expired_order_text(order['id'])) for order in cancelled)
+    except Exception as e:
+        logger.error(f"Error cancelling expired orders: {e}")
+    
+    if messages:
+        logger.info(f"Sweep cancelled {len(messages)} expired orders")
+        await notify_users(messages)
+
 async def check_expired_orders():
     while True:
-        conn = get_db_connection()
+        await asyncio.sleep(ORDER_SWEEP_INTERVAL)
         try:
-            with conn.cursor(cursor_factory=DictCursor) as cursor:
-                expired_time = datetime.now() - timedelta(minutes=30)
-                cursor.execute("""
-                    SELECT * FROM orders 
-                    WHERE is_paid = FALSE AND created_at < %s
-                """, (expired_time,))
-                expired_orders = cursor.fetchall()
-                
-                for order in expired_orders:
-                    try:
-                        await bot.send_message(
-                            order['user_id'],
-                            f"Ваш заказ #{order['id']} был отменен, так как оплата не поступила в течение 30 минут."
-                        )
-                    except Exception as e:
-                        logger.error(f"Error notifying user about expired order: {e}")
-                    
-                    cursor.execute("""
-                        UPDATE orders SET is_cancelled = TRUE WHERE id = %s
-                    """, (order['id'],))
-                    conn.commit()
+            await expire_orders()
         except Exception as e:
             logger.error(f"Error checking expired orders: {e}")
+
+# Фоновые обязанности, которые должны выполняться ровно в одном процессе:
+# опрос кошелька и страховочная отмена просроченных заказов в базе
+class BackgroundDuties:
+    def __init__(self):
+        self.active = False
+
+    def start(self):
+        if not self.active:
+            self.active = True
+            payment_watcher.start()
+            logger.info("Background duties started")
+
+    async def stop(self):
+        if self.active:
+            self.active = False
+            await payment_watcher.stop()
+            logger.info("Background duties stopped")
+
+background_duties = BackgroundDuties()
+
+# Выбор ведущего процесса через advisory lock Postgres: блокировка держится,
+# пока живо соединение, после падения ведущего ее забирает другой процесс
+class LeaderElection:
+    def __init__(self, key, interval):
+        self.key = key
+        self.interval = interval
+        self._conn = None
+        self._task = None
+
+    async def _try_acquire(self):
+        conn = await asyncpg.connect(**DB_CONNECT_KWARGS)
+        if await conn.fetchval("SELECT pg_try_advisory_lock($1)", self.key):
+            self._conn = conn
+            logger.info("Elected as background leader")
+            background_duties.start()
+        else:
+            await conn.close()
+
+    async def _run(self):
+        while True:
+            try:
+                if self._conn is None:
+                    await self._try_acquire()
+                else:
+                    await self._conn.fetchval("SELECT 1")
+            except Exception as e:
+                logger.error(f"Leader election error: {e}")
+                await self._release()
+            await asyncio.sleep(self.interval)
+
+    async def _release(self):
+        await background_duties.stop()
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            try:
+                await conn.close()
+            except Exception:
+                pass
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self._release()
+
+leader_election = LeaderElection(LEADER_LOCK_KEY, LEADER_CHECK_INTERVAL)
+
+# Шардированный режим: главный процесс получает обновления и раздает их
+# SHARD_WORKERS процессам по user_id, так что обновления одного пользователя
+# всегда обрабатываются одним процессом и по порядку. События заказов
+# рассылаются всем процессам, чтобы ведущий видел все ожидающие оплаты.
+# Процессы вебхука (WEBHOOK_WORKERS > 1) получают обновления сами, но заказами
+# обмениваются так же: кошелек опрашивает только ведущий
+shard = None
+
+def owns_order(order):
+    return shard is None or shard.order_owner(order) == shard.index
+
+def update_user_id(data):
+    for value in data.values():
+        if isinstance(value, dict) and 'from' in value:
+            return value['from']['id']
+    return 0
+
+async def apply_order_event(event):
+    kind = event['kind']
+    if kind == 'order_added':
+        order = Order(**event['order'])
+        if not owns_order(order):
+            payment_watcher.add(order)
+    elif kind == 'order_removed':
+        order = payment_watcher.get(event['order_id'])
+        if order is not None and not owns_order(order):
+            payment_watcher.remove(order.id)
+    elif kind == 'order_paid':
+        order = payment_watcher.get(event['order_id'])
+        received_amount = satoshi_to_btc(event['received_satoshi'])
+        if order is None or order.status == 'cancelled':
+            # Владелец успел отменить заказ по сроку, пока шло событие
+            report_unmatched_payment(
+                f"Оплата пришла после отмены заказа {event['order_id']}: {received_amount:.8f} BTC"
+            )
+        elif order.status == 'pending':
+            order.status = 'paid'
+            await settle_order(order, received_amount)
+
+class ShardRuntime:
+    def __init__(self, index, count, inbox, events, receives_updates=True):
+        self.index = index
+        self.count = count
+        self.inbox = inbox
+        self.events = events
+        self.receives_updates = receives_updates
+        self._tails = {}
+        self._listener = None
+
+    def order_owner(self, order):
+        # Заказ принадлежит создавшему его процессу: у каждого процесса свои
+        # остатки меток (SatoshiTagAllocator.partition)
+        return (order.unique_satoshi - 1) % self.count
+
+    def publish(self, event, target=None):
+        self.events.put((target, event))
+
+    async def _listen(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            kind, payload = await loop.run_in_executor(None, self.inbox.get)
+            if kind == 'stop':
+                break
+            try:
+                await apply_order_event(payload)
+            except Exception as e:
+                logger.error(f"Error applying order event {payload.get('kind')}: {e}")
+
+    def start_listening(self):
+        # Для процессов, которые сами получают обновления: из очереди
+        # приходят только события заказов
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop_listening(self):
+        if self._listener is not None:
+            self.inbox.put(('stop', None))
+            await self._listener
+            self._listener = None
+
+    def _dispatch(self, data):
+        user_id = update_user_id(data)
+        task = asyncio.create_task(self._process(self._tails.get(user_id), data))
+        self._tails[user_id] = task
+        task.add_done_callback(lambda t: self._tails.get(user_id) is t and self._tails.pop(user_id))
+
+    async def _process(self, previous, data):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await dp.process_update(types.Update(**data))
+        except Exception as e:
+            logger.error(f"Error processing update {data.get('update_id')}: {e}")
+
+    async def serve(self):
+        Bot.set_current(bot)
+        Dispatcher.set_current(dp)
+        loop = asyncio.get_running_loop()
+        await on_startup(dp)
+        try:
+            while True:
+                kind, payload = await loop.run_in_executor(None, self.inbox.get)
+                if kind == 'stop':
+                    break
+                if kind == 'update':
+                    self._dispatch(payload)
+                else:
+                    await apply_order_event(payload)
+            if self._tails:
+                await asyncio.wait(list(self._tails.values()))
         finally:
-            conn.close()
-        
-        await asyncio.sleep(60)
+            await on_shutdown(dp)
+            await dp.storage.close()
+            await bot.session.close()
+
+def run_shard_worker(index, count, inbox, events, log_queue):
+    global shard, METRICS_PORT
+    route_logs(log_queue)
+    # Остановка приходит от главного процесса, а не по Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    shard = ShardRuntime(index, count, inbox, events)
+    tag_allocator.partition(index, count)
+    outbox.partition(count)
+    if METRICS_PORT:
+        METRICS_PORT += index
+    asyncio.run(shard.serve())
+
+def relay_shard_events(inboxes, events):
+    while True:
+        target, event = events.get()
+        for index, inbox in enumerate(inboxes):
+            if target is None or target == index:
+                inbox.put(('event', event))
+
+def route_update(inboxes, data):
+    inboxes[update_user_id(data) % len(inboxes)].put(('update', data))
+
+async def run_shard_front(inboxes, stopping):
+    runner = None
+    offset = None
+    try:
+        if BOT_MODE == 'webhook':
+            async def handle_update(request):
+                route_update(inboxes, await request.json())
+                return web.Response()
+            
+            app = web.Application()
+            app.router.add_post(WEBHOOK_PATH, handle_update)
+            runner = web.AppRunner(app)
+            await runner.setup()
+            await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+            await ensure_webhook()
+            await stopping.wait()
+        else:
+            await bot.delete_webhook(drop_pending_updates=SKIP_UPDATES)
+            delay = 1
+            while not stopping.is_set():
+                # Сетевые ошибки и ошибки API не прерывают прием, как и в start_polling
+                try:
+                    updates = await bot.get_updates(offset=offset, timeout=20)
+                except Exception as e:
+                    logger.error(f"Error getting updates, retrying in {delay}s: {e}")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+                    continue
+                delay = 1
+                for update in updates:
+                    route_update(inboxes, update.to_python())
+                    offset = update.update_id + 1
+    finally:
+        if offset is not None:
+            # Подтверждаем уже разосланные обновления, чтобы они не пришли повторно
+            try:
+                await bot.get_updates(offset=offset, limit=1, timeout=0)
+            except Exception as e:
+                logger.error(f"Error confirming updates up to {offset}: {e}")
+        if runner is not None:
+            await runner.cleanup()
+        await bot.session.close()
+
+def run_sharded():
+    if BOT_MODE == 'webhook' and not WEBHOOK_HOST:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_HOST")
+    context = multiprocessing.get_context('spawn')
+    inboxes = [context.Queue() for _ in range(SHARD_WORKERS)]
+    events = context.Queue()
+    log_queue = worker_log_queue(context)
+    workers = [
+        context.Process(
+            target=run_shard_worker,
+            args=(index, SHARD_WORKERS, inboxes[index], events, log_queue),
+            name=f'shard-{index}'
+        )
+        for index in range(SHARD_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=relay_shard_events, args=(inboxes, events), daemon=True).start()
+    
+    failure = None
+    
+    async def front():
+        nonlocal failure
+        stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stopping.set)
+        task = asyncio.create_task(run_shard_front(inboxes, stopping))
+        # Упавший процесс или прием обновлений останавливают весь бот: иначе
+        # обновления копились бы в очереди мертвого процесса
+        while not stopping.is_set():
+            dead = [worker for worker in workers if not worker.is_alive()]
+            if dead:
+                failure = f"Shard worker {dead[0].name} exited with code {dead[0].exitcode}"
+                break
+            if task.done():
+                failure = f"Update receiver stopped: {task.exception()!r}"
+                break
+            try:
+                await asyncio.wait_for(stopping.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+        # Long polling прерывается сразу, уже полученные обновления разосланы
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    
+    try:
+        asyncio.run(front())
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop', None))
+        for worker in workers:
+            worker.join()
+    if failure is not None:
+        logger.critical(f"{failure}, shutting down")
+        sys.exit(1)
 
 # Запуск бота
+# Общие хуки запуска и остановки для long polling и webhook
 async def on_startup(dp):
+    started = time.perf_counter()
+    await start_metrics_server()
+    await create_http_session()
+    await ensure_schema()
+    # Частые запросы подготавливаются на соединениях пула при его создании
+    await create_db_pool()
+    order_journal.start()
+    outbox.start()
+    # Кэши прогреваются параллельно и до приема обновлений
+    warmups = [catalog.load(), link_allocator.load(), rate_service.refresh(), restore_pending_orders()]
+    if isinstance(storage, KeyValueStorage):
+        warmups.append(storage.setup())
+    await asyncio.gather(*warmups)
+    link_allocator.start()
+    rate_service.start()
+    tag_allocator.rebuild(payment_watcher.orders.values())
+    if shard is None:
+        background_duties.start()
+    else:
+        leader_election.start()
+        if not shard.receives_updates:
+            shard.start_listening()
+    await schedule_pending_orders()
+    deadline_scheduler.start()
     asyncio.create_task(check_expired_orders())
-    logger.info("Bot started")
+    # В шардированном режиме обновления получает главный процесс
+    if shard is None or not shard.receives_updates:
+        if BOT_MODE == 'webhook':
+            await ensure_webhook()
+        else:
+            # Накопленные обновления сохраняются, если не задан SKIP_UPDATES
+            await bot.delete_webhook(drop_pending_updates=SKIP_UPDATES)
     await bot.delete_my_commands()
+    logger.info(f"Bot started in {time.perf_counter() - started:.2f}s")
+
+async def on_shutdown(dp):
+    if shard is not None:
+        await shard.stop_listening()
+    await deadline_scheduler.stop()
+    await link_allocator.stop()
+    await leader_election.stop()
+    await background_duties.stop()
+    await rate_service.stop()
+    await close_http_session()
+    await outbox.stop()
+    await order_journal.stop()
+    if isinstance(storage, KeyValueStorage):
+        await storage.flush()
+    await close_db_pool()
+    await stop_metrics_server()
+    logger.info("Bot stopped")
+
+async def ensure_webhook():
+    # Вебхук не удаляется при остановке: Telegram копит обновления до перезапуска
+    url = WEBHOOK_HOST.rstrip('/') + WEBHOOK_PATH
+    info = await bot.get_webhook_info()
+    if info.url != url:
+        await bot.set_webhook(url, drop_pending_updates=SKIP_UPDATES)
+        logger.info(f"Webhook set to {url}")
+
+def run_webhook(worker_index=0, log_queue=None, inbox=None, events=None):
+    global shard, METRICS_PORT
+    if log_queue is not None:
+        route_logs(log_queue)
+    if WEBHOOK_WORKERS > 1:
+        shard = ShardRuntime(worker_index, WEBHOOK_WORKERS, inbox, events, receives_updates=False)
+        tag_allocator.partition(worker_index, WEBHOOK_WORKERS)
+        outbox.partition(WEBHOOK_WORKERS)
+        if METRICS_PORT:
+            METRICS_PORT += worker_index
+    executor.start_webhook(
+        dispatcher=dp,
+        webhook_path=WEBHOOK_PATH,
+        on_startup=on_startup,
+        on_shutdown=on_shutdown,
+        skip_updates=False,
+        host=WEBAPP_HOST,
+        port=WEBAPP_PORT,
+        reuse_port=WEBHOOK_WORKERS > 1
+    )
+
+def start_webhook_workers():
+    if not WEBHOOK_HOST:
+        raise RuntimeError("BOT_MODE=webhook requires WEBHOOK_HOST")
+    if WEBHOOK_WORKERS == 1:
+        run_webhook()
+        return
+    if not isinstance(storage, KeyValueStorage):
+        raise RuntimeError("WEBHOOK_WORKERS > 1 requires FSM_STORAGE=postgres or redis")
+    
+    # Несколько процессов слушают один порт (SO_REUSEPORT), ядро распределяет соединения.
+    # Заказы рассылаются между процессами, как в шардированном режиме
+    log_queue = worker_log_queue(multiprocessing)
+    inboxes = [multiprocessing.Queue() for _ in range(WEBHOOK_WORKERS)]
+    events = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(
+            target=run_webhook,
+            args=(index, log_queue, inboxes[index], events),
+            name=f'webhook-{index}'
+        )
+        for index in range(WEBHOOK_WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    threading.Thread(target=relay_shard_events, args=(inboxes, events), daemon=True).start()
+    
+    def stop_workers(signum, frame):
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+    
+    signal.signal(signal.SIGTERM, stop_workers)
+    signal.signal(signal.SIGINT, stop_workers)
+    for worker in workers:
+        worker.join()
 
 if __name__ == '__main__':
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+    if SHARD_WORKERS > 0:
+        run_sharded()
+    elif BOT_MODE == 'webhook':
+        start_webhook_workers()
+    else:
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=SKIP_UPDATES)
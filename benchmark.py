@@ -0,0 +1,257 @@
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import itertools
+from decimal import Decimal
+
+import asyncpg
+from aiohttp import web
+
+# Нагрузочный тест бота без выхода в сеть: локальные заглушки Telegram Bot API
+# и blockchain.info, реальный диспетчер dp и локальный Postgres (DB_* из окружения).
+#
+#   python benchmark.py --seed --users 200 --rounds 5
+#
+# Ограничители отправки и защита от флуда в бенчмарке подняты, чтобы измерялись обработчики,
+# а не лимиты Telegram; их можно переопределить переменными окружения.
+
+parser = argparse.ArgumentParser(description="Offline load test for Bot.py")
+parser.add_argument('--users', type=int, default=100, help="number of simulated users")
+parser.add_argument('--rounds', type=int, default=3, help="checkouts per user")
+parser.add_argument('--pay-ratio', type=float, default=0.5, help="share of orders that get paid")
+parser.add_argument('--telegram-port', type=int, default=8781)
+parser.add_argument('--chain-port', type=int, default=8782)
+parser.add_argument('--seed', action='store_true', help="create fixture tables and catalog data")
+parser.add_argument('--links', type=int, default=10000, help="links per location when seeding")
+args = parser.parse_args()
+
+BENCH_TOKEN = '123456789:AAbenchmarkbenchmarkbenchmarkbenchm'
+BENCH_WALLET = '1BenchWa11etAddressxxxxxxxxxxxxxxx'
+ADMIN_ID = 1
+
+os.environ.update({
+    'TELEGRAM_BOT_TOKEN': BENCH_TOKEN,
+    'ADMIN_IDS': str(ADMIN_ID),
+    'BITCOIN_WALLET': BENCH_WALLET,
+    'TELEGRAM_API_SERVER': f'http://127.0.0.1:{args.telegram_port}',
+    'BLOCKCHAIN_API_URL': f'http://127.0.0.1:{args.chain_port}/',
+})
+os.environ.setdefault('SEND_GLOBAL_RATE', '100000')
+os.environ.setdefault('SEND_CHAT_RATE', '100000')
+os.environ.setdefault('SEND_CHAT_BURST', '1000')
+os.environ.setdefault('FLOOD_RATE', '100000')
+os.environ.setdefault('FLOOD_BURST', '1000')
+os.environ.setdefault('PAYMENT_POLL_INTERVAL', '1')
+os.environ.setdefault('RATE_SOURCES', 'blockchain')
+
+import Bot as shop
+from aiogram import Bot, Dispatcher, types
+
+FIXTURE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS categories (
+        id SERIAL PRIMARY KEY, name TEXT NOT NULL, is_active BOOLEAN NOT NULL DEFAULT TRUE
+    );
+    CREATE TABLE IF NOT EXISTS products (
+        id SERIAL PRIMARY KEY, name TEXT NOT NULL, description TEXT, price_rub NUMERIC NOT NULL,
+        category_id INTEGER REFERENCES categories(id), is_active BOOLEAN NOT NULL DEFAULT TRUE
+    );
+    CREATE TABLE IF NOT EXISTS locations (
+        id SERIAL PRIMARY KEY, name TEXT NOT NULL, is_active BOOLEAN NOT NULL DEFAULT TRUE
+    );
+    CREATE TABLE IF NOT EXISTS location_links (
+        id SERIAL PRIMARY KEY, location_id INTEGER REFERENCES locations(id),
+        content_link TEXT NOT NULL, is_used BOOLEAN NOT NULL DEFAULT FALSE
+    );
+    CREATE TABLE IF NOT EXISTS orders (
+        id SERIAL PRIMARY KEY, user_id BIGINT NOT NULL, is_paid BOOLEAN NOT NULL DEFAULT FALSE,
+        is_cancelled BOOLEAN NOT NULL DEFAULT FALSE, created_at TIMESTAMP NOT NULL DEFAULT NOW()
+    );
+    CREATE TABLE IF NOT EXISTS shop_info (about_text TEXT, updated_at TIMESTAMP)
+"""
+
+# Заглушка Telegram Bot API
+telegram_calls = itertools.count(1)
+message_ids = itertools.count(1)
+
+async def telegram_method(request):
+    method = request.match_info['method']
+    data = dict(await request.post()) if request.can_read_body else {}
+    next(telegram_calls)
+    if method == 'getMe':
+        result = {'id': 123456789, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+    elif method == 'sendMessage':
+        result = {
+            'message_id': next(message_ids),
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'private'},
+            'text': data.get('text', ''),
+        }
+    else:
+        result = True
+    return web.json_response({'ok': True, 'result': result})
+
+# Заглушка blockchain.info: курс и транзакции кошелька
+chain_txs = []
+
+async def chain_ticker(request):
+    return web.json_response({'RUB': {'last': 5000000.0}})
+
+async def chain_rawaddr(request):
+    limit = int(request.query.get('limit', 50))
+    offset = int(request.query.get('offset', 0))
+    newest_first = chain_txs[::-1]
+    return web.json_response({'n_tx': len(chain_txs), 'txs': newest_first[offset:offset + limit]})
+
+def pay(order):
+    chain_txs.append({
+        'hash': f'tx{len(chain_txs)}',
+        'time': int(time.time()),
+        'out': [{'addr': BENCH_WALLET, 'value': order.amount_satoshi}],
+    })
+
+async def start_fakes():
+    telegram = web.Application()
+    telegram.router.add_route('*', '/bot{token}/{method}', telegram_method)
+    chain = web.Application()
+    chain.router.add_get('/ticker', chain_ticker)
+    chain.router.add_get('/rawaddr/{address}', chain_rawaddr)
+    runners = []
+    for app, port in ((telegram, args.telegram_port), (chain, args.chain_port)):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        runners.append(runner)
+    return runners
+
+async def seed():
+    # Отдельное соединение: пул бота подготавливает запросы к еще не созданным таблицам
+    conn = await asyncpg.connect(**shop.DB_CONNECT_KWARGS)
+    try:
+        await conn.execute(FIXTURE_SCHEMA)
+        if await conn.fetchval("SELECT count(*) FROM categories"):
+            return
+        await conn.execute("INSERT INTO shop_info (about_text) VALUES ('Benchmark shop')")
+        category_ids = [
+            await conn.fetchval("INSERT INTO categories (name) VALUES ($1) RETURNING id", f"Категория {i}")
+            for i in range(5)
+        ]
+        await conn.executemany(
+            "INSERT INTO products (name, description, price_rub, category_id) VALUES ($1, $2, $3, $4)",
+            [(f"Товар {i}", "Описание", Decimal(1000 + i), category_ids[i % 5]) for i in range(50)]
+        )
+        location_ids = [
+            await conn.fetchval("INSERT INTO locations (name) VALUES ($1) RETURNING id", f"Локация {i}")
+            for i in range(10)
+        ]
+        await conn.copy_records_to_table(
+            'location_links',
+            records=[(lid, f'https://example.com/{lid}/{n}', False) for lid in location_ids for n in range(args.links)],
+            columns=('location_id', 'content_link', 'is_used')
+        )
+    finally:
+        await conn.close()
+
+# Синтетические апдейты
+update_ids = itertools.count(1)
+
+def user_payload(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f'User{user_id}', 'username': f'user{user_id}'}
+
+def message_update(user_id, text):
+    return {
+        'update_id': next(update_ids),
+        'message': {
+            'message_id': next(update_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': user_payload(user_id),
+            'text': text,
+        },
+    }
+
+def callback_update(user_id, data):
+    return {
+        'update_id': next(update_ids),
+        'callback_query': {
+            'id': str(next(update_ids)),
+            'from': user_payload(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+                'text': '',
+            },
+        },
+    }
+
+latencies = {}
+products_by_category = {}
+
+async def feed(step, payload):
+    started = time.perf_counter()
+    await shop.dp.process_update(types.Update(**payload))
+    latencies.setdefault(step, []).append(time.perf_counter() - started)
+
+async def simulate_user(user_id):
+    for _ in range(args.rounds):
+        await feed('catalog', message_update(user_id, "Каталог"))
+        category = random.choice(shop.catalog.categories)
+        await feed('process_category', callback_update(user_id, shop.CB_CATEGORY.pack(category['id'])))
+        product = random.choice(products_by_category[category['id']])
+        await feed('process_product', callback_update(user_id, shop.CB_PRODUCT.pack(product['id'])))
+        location = random.choice(shop.catalog.locations)
+        await feed('process_location', callback_update(user_id, shop.CB_LOCATION.pack(product['id'], location['id'])))
+        await feed('check_payment', callback_update(user_id, shop.CB_CHECK_PAYMENT.pack()))
+
+        order_id = (await shop.dp.current_state(chat=user_id, user=user_id).get_data()).get('order_id')
+        order = shop.payment_watcher.get(order_id)
+        if order is not None and random.random() < args.pay_ratio:
+            pay(order)
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+def report(elapsed):
+    total = sum(len(values) for values in latencies.values())
+    print(f"{'step':<18}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, values in latencies.items():
+        print(
+            f"{step:<18}{len(values):>8}"
+            f"{percentile(values, 0.5) * 1000:>10.2f}"
+            f"{percentile(values, 0.95) * 1000:>10.2f}"
+            f"{percentile(values, 0.99) * 1000:>10.2f}"
+        )
+    print(f"\nupdates: {total}, elapsed: {elapsed:.2f}s, updates/s: {total / elapsed:.1f}")
+    print(f"DB connections opened: {shop.db_connections_opened}")
+    print(f"Telegram API calls: {next(telegram_calls) - 1}, payments sent: {len(chain_txs)}")
+
+async def main():
+    runners = await start_fakes()
+    Bot.set_current(shop.bot)
+    Dispatcher.set_current(shop.dp)
+    try:
+        if args.seed:
+            await seed()
+        await shop.on_startup(shop.dp)
+        for product in await shop.db_fetch("SELECT id, category_id FROM products WHERE is_active = TRUE"):
+            products_by_category.setdefault(product['category_id'], []).append(product)
+        started = time.perf_counter()
+        await asyncio.gather(*(simulate_user(1000 + i) for i in range(args.users)))
+        elapsed = time.perf_counter() - started
+        # Даем наблюдателю за кошельком подтвердить оплаченные заказы
+        await asyncio.sleep(shop.PAYMENT_POLL_INTERVAL * 2)
+        report(elapsed)
+    finally:
+        await shop.on_shutdown(shop.dp)
+        await shop.bot.session.close()
+        for runner in runners:
+            await runner.cleanup()
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
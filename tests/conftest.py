@@ -0,0 +1,13 @@
+import os
+import sys
+import tempfile
+
+# Bot.py читает конфигурацию при импорте: для проверок чистой логики
+# достаточно фиктивного токена и локальных хранилищ
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:test-token')
+os.environ.setdefault('ADMIN_IDS', '1')
+os.environ.setdefault('LOG_FILE', os.path.join(tempfile.gettempdir(), 'bot-tests.log'))
+os.environ.setdefault('FSM_STORAGE', 'redis')
+os.environ.setdefault('REDIS_URL', 'local://')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,231 @@
+import asyncio
+from datetime import datetime
+from decimal import Decimal
+
+import pytest
+
+import Bot
+
+
+# Сериализация записей FSM
+def test_fsm_record_round_trip():
+    data = {
+        'price_rub': Decimal('1000.50'),
+        'order_time': datetime(2024, 5, 1, 12, 30, 15, 123456),
+        'stock': {5: 3, 7: 0},
+        'history': [Decimal('0.00012345'), {'nested': datetime(2024, 1, 1)}],
+        'name': 'товар',
+        'product_id': 3,
+        'empty': {},
+    }
+    assert Bot.load_fsm_record(Bot.dump_fsm_record('OrderStates:waiting_payment', data)) == (
+        'OrderStates:waiting_payment', data
+    )
+
+
+def test_pack_keeps_plain_dicts_and_lists_json_native():
+    assert Bot._pack({'a': [1, 'b', None]}) == {'a': [1, 'b', None]}
+    assert Bot._unpack(Bot._pack((1, 2))) == [1, 2]
+
+
+# Буфер записи FSM
+class BlockingBackend(Bot.RedisKV):
+    def __init__(self):
+        super().__init__(Bot.LocalRedis(), ttl=None)
+        self.release = asyncio.Event()
+        self.started = asyncio.Event()
+        self.failures = 0
+
+    async def write_many(self, items):
+        self.started.set()
+        await self.release.wait()
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("backend unavailable")
+        await super().write_many(items)
+
+
+def test_storage_reads_own_writes_during_flush():
+    async def scenario():
+        backend = BlockingBackend()
+        storage = Bot.KeyValueStorage(backend, flush_interval=60, flush_batch=100)
+        await storage.set_data(chat=1, user=1, data={'order_id': 'a'})
+        flush = asyncio.create_task(storage.flush())
+        await backend.started.wait()
+        # Пачка пишется, но запись еще не подтверждена
+        assert await storage.get_data(chat=1, user=1) == {'order_id': 'a'}
+        assert await backend.get(storage._key(1, 1)) is None
+        backend.release.set()
+        await flush
+        assert await storage.get_data(chat=1, user=1) == {'order_id': 'a'}
+        assert await backend.get(storage._key(1, 1)) is not None
+
+    asyncio.run(scenario())
+
+
+def test_storage_keeps_and_retries_failed_flush():
+    async def scenario():
+        backend = BlockingBackend()
+        backend.failures = 1
+        backend.release.set()
+        storage = Bot.KeyValueStorage(backend, flush_interval=0.01, flush_batch=100)
+        await storage.set_state(chat=1, user=1, state='OrderStates:selecting_location')
+        await storage.flush()
+        assert await backend.get(storage._key(1, 1)) is None
+        assert await storage.get_state(chat=1, user=1) == 'OrderStates:selecting_location'
+        # Повтор идет по таймеру, без новых записей
+        for _ in range(100):
+            if await backend.get(storage._key(1, 1)) is not None:
+                break
+            await asyncio.sleep(0.01)
+        assert await backend.get(storage._key(1, 1)) is not None
+
+    asyncio.run(scenario())
+
+
+def test_storage_newer_write_wins_over_failed_batch():
+    async def scenario():
+        backend = BlockingBackend()
+        backend.failures = 1
+        storage = Bot.KeyValueStorage(backend, flush_interval=60, flush_batch=100)
+        await storage.set_data(chat=1, user=1, data={'step': 1})
+        flush = asyncio.create_task(storage.flush())
+        await backend.started.wait()
+        await storage.set_data(chat=1, user=1, data={'step': 2})
+        backend.release.set()
+        await flush
+        assert await storage.get_data(chat=1, user=1) == {'step': 2}
+        await storage.flush()
+        assert Bot.load_fsm_record(await backend.get(storage._key(1, 1)))[1] == {'step': 2}
+
+    asyncio.run(scenario())
+
+
+# Данные кнопок
+@pytest.mark.parametrize('action, values', [
+    (Bot.CB_CATEGORY, (7,)),
+    (Bot.CB_PRODUCT_PAGE, (3, 123456789, 1)),
+    (Bot.CB_PRODUCT, (0,)),
+    (Bot.CB_LOCATION_PAGE, (100, 35, 0)),
+    (Bot.CB_LOCATION, (100, 5)),
+    (Bot.CB_CHECK_PAYMENT, ()),
+])
+def test_callback_round_trip(action, values):
+    data = action.pack(*values)
+    assert Bot.unpack_callback(data) == (action, dict(zip(action.fields, values)))
+
+
+def test_callback_pack_is_compact():
+    assert Bot.CB_LOCATION.pack(100, 5) == '1l:2s:5'
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    '',
+    'l:2s:5',
+    '2l:2s:5',
+    '1z:1',
+    '1l:2s',
+    '1l:2s:5:1',
+    '1l:-1:5',
+    '1l:+1:5',
+    '1l:01:5',
+    '1l: 1:5',
+    '1l:1_0:5',
+    '1l:2S:5',
+    '1l::5',
+    '1y:',
+])
+def test_callback_rejects_foreign_and_non_canonical_data(data):
+    assert Bot.unpack_callback(data) is None
+
+
+def test_callback_pack_rejects_bad_values():
+    with pytest.raises(ValueError):
+        Bot.CB_LOCATION.pack(-1, 5)
+    with pytest.raises(ValueError):
+        Bot.CB_LOCATION.pack(1)
+    with pytest.raises(ValueError):
+        Bot.CB_PRODUCT_PAGE.pack(36 ** 20, 36 ** 20, 36 ** 20)
+
+
+# Уникальные добавки в сатоши
+def allocate_all(allocator, key, count, taken=()):
+    taken = set(taken)
+    tags = []
+    for _ in range(count):
+        tag = allocator.allocate(key, 0, lambda amount: amount in taken)
+        taken.add(tag)
+        tags.append(tag)
+    return tags
+
+
+def test_tags_are_unique_and_released():
+    allocator = Bot.SatoshiTagAllocator(10, 0.5)
+    tags = allocate_all(allocator, Decimal('100'), 5)
+    assert len(set(tags)) == 5
+    assert all(1 <= tag <= 10 for tag in tags)
+    bucket = allocator._buckets[Decimal('100')]
+    allocator.release(Decimal('100'), tags[0])
+    assert tags[0] not in bucket.used and tags[0] in bucket.free
+    # Повторное освобождение ничего не ломает
+    allocator.release(Decimal('100'), tags[0])
+    assert bucket.free.count(tags[0]) == 1
+    # У каждой цены свой диапазон
+    assert all(1 <= tag <= 10 for tag in allocate_all(allocator, Decimal('200'), 5))
+
+
+def test_tags_widen_under_load_and_skip_taken_amounts():
+    allocator = Bot.SatoshiTagAllocator(10, 0.5)
+    tags = allocate_all(allocator, Decimal('100'), 12, taken={3, 4})
+    assert len(set(tags)) == 12
+    assert not {3, 4} & set(tags)
+    assert max(tags) > 10
+    assert allocator._buckets[Decimal('100')].size >= 20
+    for tag in tags:
+        allocator.release(Decimal('100'), tag)
+    # Опустевший расширенный диапазон сбрасывается к исходному
+    assert Decimal('100') not in allocator._buckets
+
+
+def test_tags_rebuild_reserves_restored_orders():
+    allocator = Bot.SatoshiTagAllocator(4, 1.0)
+    order = Bot.Order(
+        id='a', user_id=1, username='u', product_id=1, location_id=1, price_rub=Decimal('100'),
+        btc_amount=Decimal('0.00010003'), unique_satoshi=3, rate=Decimal('5000000'),
+        created_at=datetime.now()
+    )
+    allocator.rebuild([order])
+    assert 3 not in allocate_all(allocator, Decimal('100'), 3)
+
+
+def test_partitioned_tags_split_the_range():
+    allocators = [Bot.SatoshiTagAllocator(300, 0.5) for _ in range(4)]
+    for index, allocator in enumerate(allocators):
+        allocator.partition(index, 4)
+        assert allocator.local_range == 75
+    per_worker = [allocate_all(allocator, Decimal('100'), 30) for allocator in allocators]
+    for index, (allocator, tags) in enumerate(zip(allocators, per_worker)):
+        assert all((tag - 1) % 4 == index for tag in tags)
+        assert all(allocator.owns(tag) for tag in tags)
+        # Добавка не растет с числом процессов
+        assert max(tags) <= 300
+    all_tags = [tag for tags in per_worker for tag in tags]
+    assert len(set(all_tags)) == len(all_tags)
+    # Чужие метки не освобождаются и не резервируются
+    allocators[0].release(Decimal('100'), per_worker[1][0])
+    allocators[0].reserve(Decimal('100'), per_worker[1][0])
+    assert len(allocators[0]._buckets[Decimal('100')].used) == 30
+
+
+def test_partitioned_totals_never_coincide_across_workers():
+    allocators = [Bot.SatoshiTagAllocator(8, 1.0) for _ in range(3)]
+    totals = {}
+    for index, allocator in enumerate(allocators):
+        allocator.partition(index, 3)
+        for base in range(1000, 1010):
+            aligned = allocator.align(base)
+            assert aligned % 3 == 0 and 0 <= aligned - base < 3
+            for tag in allocate_all(allocator, Decimal(base), 2):
+                total = aligned + tag
+                assert totals.setdefault(total, index) == index